@@ -1,8 +1,12 @@
 #include <stdio.h>
 #include <assert.h>
 #include "ATen/ATen.h"
+#include <ATen/cuda/CUDAContext.h>
 typedef at::BFloat16 bf16;
 
+// timesteps of r/k staged in shared memory per tile of the forward pass
+#define _Tc_ 16
+
 template <typename F>
 __global__ void kernel_forward(const int B, const int T, const int C, const int H,
                                const F *__restrict__ const _r, const F *__restrict__ const _k, const F *__restrict__ const _v, const float *__restrict__ _w, const F *__restrict__ _u,
@@ -14,7 +18,7 @@ __global__ void kernel_forward(const int B, const int T, const int C, const int
     _w += h*_N_;
     _u += h*_N_;
 
-    __shared__ float r[_N_], k[_N_], u[_N_], w[_N_];
+    __shared__ float r[_Tc_][_N_], k[_Tc_][_N_], u[_N_], w[_N_];
     float state[_N_] = {0};
 
     __syncthreads();
@@ -22,49 +26,60 @@ __global__ void kernel_forward(const int B, const int T, const int C, const int
     u[i] = float(_u[i]);
     __syncthreads();
 
-    for (int t = b*T*C + h*_N_ + i; t < (b+1)*T*C + h*_N_ + i; t += C)
+    const int t000 = b*T*C + h*_N_ + i;
+    for (int tc = 0; tc < T; tc += _Tc_)
     {
+        // load a tile of r/k once, so the block syncs per tile instead of per timestep
+        const int Tc = min(_Tc_, T - tc);
         __syncthreads();
-        r[i] = float(_r[t]);
-        k[i] = float(_k[t]);
+        for (int q = 0; q < Tc; q++)
+        {
+            const int t = t000 + (tc + q) * C;
+            r[q][i] = float(_r[t]);
+            k[q][i] = float(_k[t]);
+        }
         __syncthreads();
 
-        const float v = float(_v[t]);
-        float y = 0;
-
-        #pragma unroll
-        for (int j = 0; j < _N_; j+=4)
+        for (int q = 0; q < Tc; q++)
         {
-            const float4& r_ = (float4&)(r[j]);
-            const float4& k_ = (float4&)(k[j]);
-            const float4& w_ = (float4&)(w[j]);
-            const float4& u_ = (float4&)(u[j]);
-            float4& s = (float4&)(state[j]);
-            float4 x;
+            const int t = t000 + (tc + q) * C;
+            const float v = float(_v[t]);
+            float y = 0;
+
+            #pragma unroll
+            for (int j = 0; j < _N_; j+=4)
+            {
+                const float4& r_ = (float4&)(r[q][j]);
+                const float4& k_ = (float4&)(k[q][j]);
+                const float4& w_ = (float4&)(w[j]);
+                const float4& u_ = (float4&)(u[j]);
+                float4& s = (float4&)(state[j]);
+                float4 x;
 
-            x.x = k_.x * v;
-            x.y = k_.y * v;
-            x.z = k_.z * v;
-            x.w = k_.w * v;
+                x.x = k_.x * v;
+                x.y = k_.y * v;
+                x.z = k_.z * v;
+                x.w = k_.w * v;
 
-            y += r_.x * (u_.x * x.x + s.x);
-            y += r_.y * (u_.y * x.y + s.y);
-            y += r_.z * (u_.z * x.z + s.z);
-            y += r_.w * (u_.w * x.w + s.w);
+                y += r_.x * (u_.x * x.x + s.x);
+                y += r_.y * (u_.y * x.y + s.y);
+                y += r_.z * (u_.z * x.z + s.z);
+                y += r_.w * (u_.w * x.w + s.w);
 
-            s.x = s.x * w_.x + x.x;
-            s.y = s.y * w_.y + x.y;
-            s.z = s.z * w_.z + x.z;
-            s.w = s.w * w_.w + x.w;
+                s.x = s.x * w_.x + x.x;
+                s.y = s.y * w_.y + x.y;
+                s.z = s.z * w_.z + x.z;
+                s.w = s.w * w_.w + x.w;
+            }
+            _y[t] = F(y);
         }
-        _y[t] = F(y);
     }
 }
 
 template <typename F>
 __global__ void kernel_backward(const int B, const int T, const int C, const int H,
     const F *__restrict__ const _r, const F *__restrict__ const _k, const F *__restrict__ const _v, const float *__restrict__ _w, const float *__restrict__ __w, const F *__restrict__ _u, const F *__restrict__ const _gy,
-    F *__restrict__ const _gr, F *__restrict__ const _gk, F *__restrict__ const _gv, F *__restrict__ const _gw, F *__restrict__ const _gu)
+    F *__restrict__ const _gr, F *__restrict__ const _gk, F *__restrict__ const _gv, float *__restrict__ const _gw, float *__restrict__ const _gu)
 {
     const int b = blockIdx.x / H;
     const int h = blockIdx.x % H;
@@ -102,19 +117,37 @@ __global__ void kernel_backward(const int B, const int T, const int C, const int
         float gr = 0, gu_ = 0;
 
         #pragma unroll
-        for (int j = 0; j < _N_; j++)
+        for (int j = 0; j < _N_; j+=4)
         {
-            float& s = state[j];
-            float x = k * v[j];
+            const float4& v_ = (float4&)(v[j]);
+            const float4& gy_ = (float4&)(gy[j]);
+            float4& s = (float4&)(state[j]);
+            float4 x;
+
+            x.x = k * v_.x;
+            x.y = k * v_.y;
+            x.z = k * v_.z;
+            x.w = k * v_.w;
 
-            gr += (u * x + s) * gy[j];
-            gu_ += x * gy[j];
-            s = s * w + x;
+            gr += (u * x.x + s.x) * gy_.x;
+            gr += (u * x.y + s.y) * gy_.y;
+            gr += (u * x.z + s.z) * gy_.z;
+            gr += (u * x.w + s.w) * gy_.w;
+
+            gu_ += x.x * gy_.x;
+            gu_ += x.y * gy_.y;
+            gu_ += x.z * gy_.z;
+            gu_ += x.w * gy_.w;
+
+            s.x = s.x * w + x.x;
+            s.y = s.y * w + x.y;
+            s.z = s.z * w + x.z;
+            s.w = s.w * w + x.w;
         }
         _gr[t] = F(gr);
         gu += float(_r[t]) * gu_;
     }
-    _gu[b*C + h*_N_ + i] = F(gu);
+    atomicAdd(_gu + h*_N_ + i, gu); // summed over the batch
     
     for (int t = t000; t < t222; t += C)
     {
@@ -127,20 +160,31 @@ __global__ void kernel_backward(const int B, const int T, const int C, const int
         float gw_ = 0;
         
         #pragma unroll
-        for (int j = 0; j < _N_; j++)
+        for (int j = 0; j < _N_; j+=4)
         {
-            float& s = saaaa[j];
-            float& s2 = sbbbb[j];
-            float x = k * v[j];
-            
-            float tmp = w * (x + s);
-            s = tmp;
-            s2 = tmp + w * s2;
-            gw_ += s2 * gy[j];
+            const float4& v_ = (float4&)(v[j]);
+            const float4& gy_ = (float4&)(gy[j]);
+            float4& s = (float4&)(saaaa[j]);
+            float4& s2 = (float4&)(sbbbb[j]);
+
+            s.x = w * (k * v_.x + s.x);
+            s.y = w * (k * v_.y + s.y);
+            s.z = w * (k * v_.z + s.z);
+            s.w = w * (k * v_.w + s.w);
+
+            s2.x = s.x + w * s2.x;
+            s2.y = s.y + w * s2.y;
+            s2.z = s.z + w * s2.z;
+            s2.w = s.w + w * s2.w;
+
+            gw_ += s2.x * gy_.x;
+            gw_ += s2.y * gy_.y;
+            gw_ += s2.z * gy_.z;
+            gw_ += s2.w * gy_.w;
         }
         gw += float(_r[t + 2*C]) * gw_;
     }    
-    _gw[b*C + h*_N_ + i] = F(ww * gw);
+    atomicAdd(_gw + h*_N_ + i, ww * gw); // summed over the batch
 
     for (int t = t111 - C; t >= t000; t -= C)
     {
@@ -153,13 +197,27 @@ __global__ void kernel_backward(const int B, const int T, const int C, const int
         float gk = 0;
 
         #pragma unroll
-        for (int j = 0; j < _N_; j++)
+        for (int j = 0; j < _N_; j+=4)
         {
-            float& s = scccc[j];
-            float x = rr * gy[j];
-            
-            gk += (u * x + s) * v[j];
-            s = x + s * w;
+            const float4& v_ = (float4&)(v[j]);
+            const float4& gy_ = (float4&)(gy[j]);
+            float4& s = (float4&)(scccc[j]);
+            float4 x;
+
+            x.x = rr * gy_.x;
+            x.y = rr * gy_.y;
+            x.z = rr * gy_.z;
+            x.w = rr * gy_.w;
+
+            gk += (u * x.x + s.x) * v_.x;
+            gk += (u * x.y + s.y) * v_.y;
+            gk += (u * x.z + s.z) * v_.z;
+            gk += (u * x.w + s.w) * v_.w;
+
+            s.x = x.x + s.x * w;
+            s.y = x.y + s.y * w;
+            s.z = x.z + s.z * w;
+            s.w = x.w + s.w * w;
         }
         _gk[t] = F(gk);
     }
@@ -175,13 +233,29 @@ __global__ void kernel_backward(const int B, const int T, const int C, const int
         float gv = 0;
 
         #pragma unroll
-        for (int j = 0; j < _N_; j++)
+        for (int j = 0; j < _N_; j+=4)
         {
-            float& s = sdddd[j];
-            float x = gyy * r[j];
-            
-            gv += (u_[j] * x + s) * k[j];
-            s = x + s * w_[j];
+            const float4& r_ = (float4&)(r[j]);
+            const float4& k_ = (float4&)(k[j]);
+            const float4& uu = (float4&)(u_[j]);
+            const float4& ww_ = (float4&)(w_[j]);
+            float4& s = (float4&)(sdddd[j]);
+            float4 x;
+
+            x.x = gyy * r_.x;
+            x.y = gyy * r_.y;
+            x.z = gyy * r_.z;
+            x.w = gyy * r_.w;
+
+            gv += (uu.x * x.x + s.x) * k_.x;
+            gv += (uu.y * x.y + s.y) * k_.y;
+            gv += (uu.z * x.z + s.z) * k_.z;
+            gv += (uu.w * x.w + s.w) * k_.w;
+
+            s.x = x.x + s.x * ww_.x;
+            s.y = x.y + s.y * ww_.y;
+            s.z = x.z + s.z * ww_.z;
+            s.w = x.w + s.w * ww_.w;
         }
         _gv[t] = F(gv);
     }
@@ -191,12 +265,12 @@ void cuda_forward(int B, int T, int C, int H, bf16 *r, bf16 *k, bf16 *v, float *
 {
     assert(H*_N_ == C);
     assert(_N_%4 == 0);
-    kernel_forward<<<dim3(B * H), dim3(_N_)>>>(B, T, C, H, r, k, v, w, u, y);
+    kernel_forward<<<dim3(B * H), dim3(_N_), 0, at::cuda::getCurrentCUDAStream()>>>(B, T, C, H, r, k, v, w, u, y);
 }
 
-void cuda_backward(int B, int T, int C, int H, bf16 *r, bf16 *k, bf16 *v, float *w, float *ww, bf16 *u, bf16 *gy, bf16 *gr, bf16 *gk, bf16 *gv, bf16 *gw, bf16 *gu)
+void cuda_backward(int B, int T, int C, int H, bf16 *r, bf16 *k, bf16 *v, float *w, float *ww, bf16 *u, bf16 *gy, bf16 *gr, bf16 *gk, bf16 *gv, float *gw, float *gu)
 {
     assert(H*_N_ == C);
     assert(_N_%4 == 0);
-    kernel_backward<<<dim3(B * H), dim3(_N_)>>>(B, T, C, H, r, k, v, w, ww, u, gy, gr, gk, gv, gw, gu);
+    kernel_backward<<<dim3(B * H), dim3(_N_), 0, at::cuda::getCurrentCUDAStream()>>>(B, T, C, H, r, k, v, w, ww, u, gy, gr, gk, gv, gw, gu);
 }
@@ -12,8 +12,7 @@ from tqdm import tqdm
 from src.rwkv_tokenizer import TRIE_TOKENIZER
 from src.dataset import DEFAULT_IMAGE_TOKEN, DEFAULT_STOP_TOKEN, STOP_TOKEN_INDEX
 from src.dataset import process_image_tokens_in_conversations, preprocess
-from src.utils import Conversation, gpt4v_crop, load_image_from_base64
-from transformers import CLIPImageProcessor
+from src.utils import Conversation, gpt4v_crop, load_image_from_base64, draft_image, load_image_processor
 
 
 def split_list(lst, n):
@@ -113,6 +112,8 @@ def get_input_image_tensor(line, image_folder, image_processor, detail):
             image = Image.open(image_folder / image_file)
         else: # image is base64 encoded
             image = load_image_from_base64(image_file)
+        if args.jpeg_draft:
+            image = draft_image(image, image_processor, detail)
         if args.detail == 'high':
             image = [image] + gpt4v_crop(image)
             image_tensor = image_processor(images=image, return_tensors='pt')['pixel_values']
@@ -121,6 +122,8 @@ def get_input_image_tensor(line, image_folder, image_processor, detail):
     elif 'image_id' in line:
         image_id = line['image_id']
         image = Image.open(image_folder / ('COCO_test2015_' + str(image_id).zfill(12) + '.jpg'))
+        if args.jpeg_draft:
+            image = draft_image(image, image_processor, detail)
         if args.detail == 'high':
             image = [image] + gpt4v_crop(image)
             image_tensor = image_processor(images=image, return_tensors='pt')['pixel_values']
@@ -146,8 +149,13 @@ def eval_model(args):
     msg = model.load_state_dict(torch.load(model_path), strict=False)
     print("msg of loading model: ", msg)
     model = model.bfloat16().to(args.device)
+    model.eval() # also lets the time mixes reuse their decay, see get_decay
+    if args.vit_quant:
+        model.quantize_vit()
+    if args.emb_quant:
+        model.quantize_decode_emb()
     tokenizer = TRIE_TOKENIZER("src/rwkv_vocab_v20230424.txt")
-    image_processor = CLIPImageProcessor.from_pretrained(args.vision_tower_name)
+    image_processor = load_image_processor(args.vision_tower_name, use_fast=args.fast_image_processor)
 
     questions = load_questions(args.question_file)
     questions = get_chunk(questions, args.num_chunks, args.chunk_idx)
@@ -227,7 +235,7 @@ if __name__ == "__main__":
     parser.add_argument("--vision_tower_name", default="openai/clip-vit-base-patch32", type=str)  # openai/clip-vit-base-patch32
     parser.add_argument("--grid_size", type=int, default=8) # -1 for no grid, 0 for cls token, 1 for global avg, 8 for 64 tokens
     parser.add_argument("--detail", type=str, default="low")
-    parser.add_argument("--grad_cp", default=0, type=int)  # gradient checkpt: saves VRAM, but slower
+    parser.add_argument("--grad_cp", default=0, type=int)  # gradient checkpt: saves VRAM, but slower (1: att and ffn, 2: ffn only)
     # arguments for evaluation
     parser.add_argument("--model_path", type=str, default=None)
     parser.add_argument("--image_folder", type=str, default=None)
@@ -243,6 +251,12 @@ if __name__ == "__main__":
     parser.add_argument("--image_position", default='first', type=str)  # 'first' or 'last' or ''middle
     parser.add_argument("--image_scanning", default='unidirection', type=str, 
                         choices=['unidirection', 'bidirection', 'multidirection']) 
+    parser.add_argument("--compile_vit", default=0, type=int)  # torch.compile the frozen vit
+    parser.add_argument("--vit_quant", default=0, type=int)  # int8 weight-only vit, needs torchao
+    parser.add_argument("--emb_quant", default=0, type=int)  # int8 embedding with per row scale for the decode steps
+    parser.add_argument("--compile_decode", default=0, type=int)  # torch.compile the one token decode step of generate
+    parser.add_argument("--fast_image_processor", default=0, type=int)  # batched torchvision image preprocessing, see load_image_processor
+    parser.add_argument("--jpeg_draft", default=0, type=int)  # decode large jpegs at reduced resolution, see draft_image
     args = parser.parse_args()
     #
     os.environ["RWKV_HEAD_SIZE_A"] = str(args.head_size_a)
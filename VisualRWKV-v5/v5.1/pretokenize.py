@@ -0,0 +1,41 @@
+from src.rwkv_tokenizer import TRIE_TOKENIZER
+from src.dataset import process_image_tokens_in_conversations, process_tokens_in_conversations, _add_speaker_and_signal, tokenize_conversations, get_human_mask, load_data_file
+import argparse
+import json
+import os
+from tqdm import tqdm
+import numpy as np
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_file", type=str, default="data.json")
+    parser.add_argument("output_dir", type=str, default="tokenized")
+    parser.add_argument("--image_position", default='first', type=str)  # must match train.py
+    args = parser.parse_args()
+    return args
+
+if __name__ == "__main__":
+    # tokenize the training data once, then pass --tokenized_dir output_dir to train.py
+    args = parse_args()
+    tokenizer = TRIE_TOKENIZER("src/rwkv_vocab_v20230424.txt")
+    data_list = load_data_file(args.data_file)
+    input_ids, human_mask, offsets = [], [], [0]
+    for data in tqdm(data_list):
+        conversations = data["conversations"]
+        if "image" in data:
+            conversations = process_image_tokens_in_conversations(conversations, image_position=args.image_position)
+        else:
+            conversations = process_tokens_in_conversations(conversations)
+        conversations = _add_speaker_and_signal(conversations)
+        ids, tokenized_lens, speakers = tokenize_conversations(conversations, tokenizer, has_image=("image" in data))
+        input_ids.extend(ids)
+        human_mask.append(get_human_mask(tokenized_lens, speakers))
+        offsets.append(len(input_ids))
+    os.makedirs(args.output_dir, exist_ok=True)
+    np.save(os.path.join(args.output_dir, "input_ids.npy"), np.array(input_ids, dtype=np.int32))
+    np.save(os.path.join(args.output_dir, "human_mask.npy"), np.concatenate(human_mask).astype(bool))
+    np.save(os.path.join(args.output_dir, "offsets.npy"), np.array(offsets, dtype=np.int64))
+    meta = {"data_file": args.data_file, "image_position": args.image_position, "num_samples": len(data_list)}
+    json.dump(meta, open(os.path.join(args.output_dir, "meta.json"), "w"))
+    print("num samples", len(data_list))
+    print("num tokens", len(input_ids))
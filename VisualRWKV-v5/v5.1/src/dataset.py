@@ -2,14 +2,16 @@
 # The RWKV Language Model - https://github.com/BlinkDL/RWKV-LM
 ########################################################################################################
 
-import json, os, re, copy
+import json, os, re, copy, itertools, importlib
 import numpy as np
 from PIL import Image, ImageFile
 import torch
 from torch.utils.data import Dataset
 from pytorch_lightning.utilities import rank_zero_info
 from typing import Dict, List, Sequence, Any
-from .utils import gpt4v_crop, largest_3n_plus_2_prime
+from .utils import gpt4v_crop, largest_3n_plus_2_prime, draft_image
+if importlib.util.find_spec('orjson'):
+    import orjson
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
 # Model Constants
@@ -18,6 +20,14 @@ IMAGE_TOKEN_INDEX = -200
 DEFAULT_IMAGE_TOKEN = "<image>"
 STOP_TOKEN_INDEX = 261
 DEFAULT_STOP_TOKEN = "\n\n"
+MULTI_NEWLINE_PATTERN = re.compile(r"\n(\s*\n)+")
+
+
+def collapse_newlines(text):
+    # replace \n\n (and blank lines in general) with \n, there is nothing to replace without a \n
+    if "\n" not in text:
+        return text
+    return MULTI_NEWLINE_PATTERN.sub('\n', text)
 
 
 def process_image_tokens_in_conversations(
@@ -32,7 +42,7 @@ def process_image_tokens_in_conversations(
     for sentence in conversations:
         if DEFAULT_IMAGE_TOKEN in sentence['value']:
             sentence['value'] = sentence['value'].replace(DEFAULT_IMAGE_TOKEN, '').strip()
-            sentence['value'] = re.sub(r"\n(\s*\n)+", '\n', sentence['value'])
+            sentence['value'] = collapse_newlines(sentence['value'])
             if image_position == "first":
                 sentence['value'] = DEFAULT_IMAGE_TOKEN + '\n' + sentence['value']
             elif image_position == "middle":
@@ -43,7 +53,7 @@ def process_image_tokens_in_conversations(
                 raise ValueError(f"Unknown image_position: {image_position}, must be first, middle or last.")
             sentence['value'] = sentence['value'].strip()
         else:
-            sentence['value'] = re.sub(r"\n(\s*\n)+", '\n', sentence['value'].strip())
+            sentence['value'] = collapse_newlines(sentence['value'].strip())
 
     return conversations
 
@@ -56,11 +66,16 @@ def process_tokens_in_conversations(
     """
     for sentence in conversations:
         sentence['value'] = sentence['value'].strip()
-        sentence['value'] = re.sub(r"\n(\s*\n)+", '\n', sentence['value'])
+        sentence['value'] = collapse_newlines(sentence['value'])
 
     return conversations
 
 
+def copy_conversations(conversations):
+    # the processing above only reassigns sentence['value'], so copying each sentence dict is enough
+    return [dict(sentence) for sentence in conversations]
+
+
 def _add_speaker_and_signal(conversations):
     """Add speaker and start/end signal on each round."""
     for sentence in conversations:
@@ -81,21 +96,55 @@ def _add_speaker_and_signal(conversations):
 
 def tokenize_with_image_token(prompt, tokenizer, image_token_index=IMAGE_TOKEN_INDEX):
     prompt_chunks = [tokenizer.encode(chunk) for chunk in prompt.split(DEFAULT_IMAGE_TOKEN)]
+    # join the chunks with the image token in between
+    separated = itertools.chain.from_iterable(itertools.chain((image_token_index,), chunk) for chunk in prompt_chunks[1:])
+    return list(itertools.chain(prompt_chunks[0], separated))
 
-    input_ids = []
-    for chunk in prompt_chunks:
-        input_ids.extend(chunk)
-        input_ids.append(image_token_index)
 
-    return input_ids[:-1] # remove last image token
+def tokenize_conversations(conversations, tokenizer, has_image):
+    """
+    Tokenize each round of the conversations (speaker and signal already added).
+    Return the input ids, the tokenized length and the speaker of each round.
+    """
+    input_ids, tokenized_lens, speakers = [], [], []
+    for conversation in conversations:
+        if has_image and DEFAULT_IMAGE_TOKEN in conversation["value"]: # usually only the first round
+            round_ids = tokenize_with_image_token(conversation["value"], tokenizer)
+        else:
+            round_ids = tokenizer.encode(conversation["value"])
+        input_ids.extend(round_ids)
+        tokenized_lens.append(len(round_ids))
+        speakers.append(conversation["from"])
+    return input_ids, tokenized_lens, speakers
+
+
+def load_data_file(data_file):
+    # orjson parses large instruction json files several times faster, use it when installed
+    if importlib.util.find_spec('orjson'):
+        with open(data_file, "rb") as f:
+            return orjson.loads(f.read())
+    with open(data_file, "r") as f:
+        return json.load(f)
+
+
+def load_pretokenized(tokenized_dir):
+    """
+    Load the output of pretokenize.py, memory mapped:
+    input_ids and human_mask of all samples concatenated, offsets[i]:offsets[i+1] is sample i.
+    """
+    meta = json.load(open(os.path.join(tokenized_dir, "meta.json"), "r"))
+    arrays = {name: np.load(os.path.join(tokenized_dir, f"{name}.npy"), mmap_mode="r")
+              for name in ("input_ids", "human_mask", "offsets")}
+    return meta, arrays
+
+
+def get_human_mask(tokenized_lens, speakers):
+    # True for every token of the human rounds
+    return np.repeat(np.array(speakers) == "human", tokenized_lens)
 
 
 def mask_targets_from_human(targets, tokenized_lens, speakers):
-    cur_idx = 0
-    for tokenized_len, speaker in zip(tokenized_lens, speakers):
-        if speaker == "human":
-            targets[cur_idx:cur_idx + tokenized_len] = IGNORE_INDEX
-        cur_idx += tokenized_len
+    targets[torch.from_numpy(get_human_mask(tokenized_lens, speakers))] = IGNORE_INDEX
 
 
 def pad_to_max_len(input_ids, targets, max_len, pad_token_id):
@@ -105,10 +154,12 @@ def pad_to_max_len(input_ids, targets, max_len, pad_token_id):
     padding_len = max_len - len(input_ids)
     if padding_len <= 0:
         return input_ids, targets
-    # input_ids and targets are tensors
-    input_ids = torch.cat([input_ids, torch.tensor([pad_token_id] * padding_len, dtype=torch.long)])
-    targets = torch.cat([targets, torch.tensor([IGNORE_INDEX] * padding_len, dtype=torch.long)])
-    return input_ids, targets
+    # input_ids and targets are tensors, fill the padded buffers in place
+    padded_input_ids = torch.full((max_len,), pad_token_id, dtype=torch.long)
+    padded_input_ids[:len(input_ids)] = input_ids
+    padded_targets = torch.full((max_len,), IGNORE_INDEX, dtype=torch.long)
+    padded_targets[:len(targets)] = targets
+    return padded_input_ids, padded_targets
 
 
 def preprocess(conversations, tokenizer, has_image, ctx_len, pad_token_id=0, do_pad_to_max_length=True):
@@ -123,14 +174,7 @@ def preprocess(conversations, tokenizer, has_image, ctx_len, pad_token_id=0, do_
     # add end signal and concatenate together
     conversations = _add_speaker_and_signal(conversations)
     input_text = "".join([sentence["value"] for sentence in conversations])
-    input_ids, tokenized_lens, speakers = [], [], []
-    for conversation in conversations:
-        if has_image:
-            input_ids.extend(tokenize_with_image_token(conversation["value"], tokenizer))
-        else:
-            input_ids.extend(tokenizer.encode(conversation["value"]))
-        tokenized_lens.append(len(input_ids))
-        speakers.append(conversation["from"])
+    input_ids, tokenized_lens, speakers = tokenize_conversations(conversations, tokenizer, has_image)
     input_ids = torch.tensor(input_ids, dtype=torch.long)
     targets = copy.deepcopy(input_ids)
     mask_targets_from_human(targets, tokenized_lens, speakers)
@@ -144,12 +188,22 @@ class MyDataset(Dataset):
         self.args = args
         self.vocab_size = args.vocab_size
         self.tokenizer = args.tokenizer
-        self.list_data_dict = json.load(open(args.data_file, "r"))
+        self.list_data_dict = load_data_file(args.data_file)
         # shuffle the data, but deterministically
         self.list_data_dict_reverse = [x for x in reversed(self.list_data_dict)]
         self.data_size = len(self.list_data_dict)
         self.magic_prime = largest_3n_plus_2_prime(self.data_size)
         self.samples_per_epoch = self.args.epoch_steps * self.args.real_bsz
+        # tokens from pretokenize.py, so the tokenizer does not run in __getitem__
+        self.tokenized = None
+        if getattr(args, "tokenized_dir", ""):
+            meta, self.tokenized = load_pretokenized(args.tokenized_dir)
+            if meta["num_samples"] != self.data_size or meta["image_position"] != args.image_position:
+                raise ValueError(f"{args.tokenized_dir} was made with {meta}, which does not match "
+                                 f"{args.data_file} ({self.data_size} samples) and image_position {args.image_position}.")
+            rank_zero_info(f"Using pretokenized data from {args.tokenized_dir}")
+        # zero images for samples without image, created once on first use
+        self.zero_images = None
 
     def __len__(self):
         return self.args.epoch_steps * self.args.micro_bsz
@@ -166,40 +220,61 @@ class MyDataset(Dataset):
         # normally, we don't train for more than 2 epoch
         if step < self.magic_prime:
             sample = self.list_data_dict[sample_idx]
+            data_idx = sample_idx
         else:
             sample = self.list_data_dict_reverse[sample_idx]
+            data_idx = self.data_size - 1 - sample_idx
 
         if 'image' in sample:
             image_file = sample['image']
             image_folder = args.image_folder
             processor = args.image_processor
-            image = Image.open(os.path.join(image_folder, image_file)).convert('RGB')
+            image = Image.open(os.path.join(image_folder, image_file))
+            if args.jpeg_draft: # decode large jpegs at reduced resolution
+                image = draft_image(image, processor, args.detail)
+            image = image.convert('RGB')
             if args.detail == 'high':
                 image = [image] + gpt4v_crop(image)
                 image = processor(images=image, return_tensors='pt')['pixel_values']
             else:
                 image = processor.preprocess(image, return_tensors='pt')['pixel_values']
-            conversations = process_image_tokens_in_conversations(copy.deepcopy(sample["conversations"]), 
-                                                                  image_position=args.image_position)
+
+        if self.tokenized is not None:
+            data_dict = self.get_pretokenized(data_idx)
         else:
-            conversations = process_tokens_in_conversations(copy.deepcopy(sample["conversations"]))
-
-        data_dict = preprocess(
-            conversations,
-            self.tokenizer,
-            has_image=('image' in sample),
-            ctx_len=args.ctx_len,
-            pad_token_id=0)
+            if 'image' in sample:
+                conversations = process_image_tokens_in_conversations(copy_conversations(sample["conversations"]), 
+                                                                      image_position=args.image_position)
+            else:
+                conversations = process_tokens_in_conversations(copy_conversations(sample["conversations"]))
+
+            data_dict = preprocess(
+                conversations,
+                self.tokenizer,
+                has_image=('image' in sample),
+                ctx_len=args.ctx_len,
+                pad_token_id=0)
         
         # image exist in the data
         if 'image' in sample:
             data_dict['images'] = image
         else:
             # image does not exist in the data, fill with zeros
-            if args.detail == 'high':
-                crop_size = args.image_processor.crop_size
-                data_dict['images'] = torch.zeros(7, 3, crop_size['height'], crop_size['width'])
-            else:
-                crop_size = args.image_processor.crop_size
-                data_dict['images'] = torch.zeros(1, 3, crop_size['height'], crop_size['width'])
+            data_dict['images'] = self.get_zero_images()
         return data_dict
+
+    def get_zero_images(self):
+        # shared by all text-only samples, nothing downstream writes to it
+        if self.zero_images is None:
+            num_images = 7 if self.args.detail == 'high' else 1
+            crop_size = self.args.image_processor.crop_size
+            self.zero_images = torch.zeros(num_images, 3, crop_size['height'], crop_size['width'])
+        return self.zero_images
+
+    def get_pretokenized(self, data_idx):
+        start, end = self.tokenized["offsets"][data_idx], self.tokenized["offsets"][data_idx + 1]
+        input_ids = torch.from_numpy(self.tokenized["input_ids"][start:end].astype(np.int64))
+        targets = input_ids.clone()
+        targets[torch.from_numpy(self.tokenized["human_mask"][start:end].copy())] = IGNORE_INDEX
+        input_ids, targets = pad_to_max_len(input_ids, targets, self.args.ctx_len, pad_token_id=0)
+        return dict(input_ids=input_ids, labels=targets)
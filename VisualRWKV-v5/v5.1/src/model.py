@@ -2,7 +2,7 @@
 # The RWKV Language Model - https://github.com/BlinkDL/RWKV-LM
 ########################################################################################################
 
-import os, math, gc, importlib
+import os, math, gc, importlib, functools
 import torch
 # torch._C._jit_set_profiling_executor(True)
 # torch._C._jit_set_profiling_mode(True)
@@ -15,6 +15,8 @@ from transformers import CLIPVisionConfig, CLIPVisionModel
 if importlib.util.find_spec('deepspeed'):
     import deepspeed
     from deepspeed.ops.adam import DeepSpeedCPUAdam, FusedAdam
+if importlib.util.find_spec('torchao'):
+    from torchao.quantization import quantize_, int8_weight_only
 
 # from deepspeed.runtime.fp16.onebit.zoadam import ZeroOneAdam
 from .dataset import IGNORE_INDEX, IMAGE_TOKEN_INDEX
@@ -42,7 +44,8 @@ wkv5_cuda = load(name="wkv5", sources=["cuda/wkv5_op.cpp", f"cuda/wkv5_cuda.cu"]
     
 class WKV_5(torch.autograd.Function):
     @staticmethod
-    def forward(ctx, B, T, C, H, r, k, v, w, u):
+    def forward(ctx, B, T, C, H, r, k, v, w, u, ew, eew):
+        # w is only an input for its gradient, the kernels use ew = -exp(w) and eew = exp(ew)
         with torch.no_grad():
             assert r.dtype == torch.bfloat16
             assert k.dtype == torch.bfloat16
@@ -59,8 +62,8 @@ class WKV_5(torch.autograd.Function):
             assert v.is_contiguous()
             assert w.is_contiguous()
             assert u.is_contiguous()
-            ew = (-torch.exp(w.float())).contiguous()
-            eew = (torch.exp(ew)).contiguous()
+            assert ew.is_contiguous()
+            assert eew.is_contiguous()
             ctx.save_for_backward(r, k, v, eew, ew, u)
             y = torch.empty((B, T, C), device=r.device, dtype=torch.bfloat16, memory_format=torch.contiguous_format) # .uniform_(-1, 1)
             wkv5_cuda.forward(B, T, C, H, r, k, v, eew, u, y)
@@ -79,15 +82,26 @@ class WKV_5(torch.autograd.Function):
             gr = torch.empty((B, T, C), device=gy.device, requires_grad=False, dtype=torch.bfloat16, memory_format=torch.contiguous_format) # .uniform_(-1, 1)
             gk = torch.empty((B, T, C), device=gy.device, requires_grad=False, dtype=torch.bfloat16, memory_format=torch.contiguous_format) # .uniform_(-1, 1)
             gv = torch.empty((B, T, C), device=gy.device, requires_grad=False, dtype=torch.bfloat16, memory_format=torch.contiguous_format) # .uniform_(-1, 1)
-            gw = torch.empty((B, C), device=gy.device, requires_grad=False, dtype=torch.bfloat16, memory_format=torch.contiguous_format) # .uniform_(-1, 1)
-            gu = torch.empty((B, C), device=gy.device, requires_grad=False, dtype=torch.bfloat16, memory_format=torch.contiguous_format) # .uniform_(-1, 1)
+            # gw and gu are summed over the batch inside the kernel, in fp32
+            gw = torch.zeros((C,), device=gy.device, requires_grad=False, dtype=torch.float32)
+            gu = torch.zeros((C,), device=gy.device, requires_grad=False, dtype=torch.float32)
             wkv5_cuda.backward(B, T, C, H, r, k, v, eew, ew, u, gy, gr, gk, gv, gw, gu)
-            gw = torch.sum(gw, 0).view(H, C//H)
-            gu = torch.sum(gu, 0).view(H, C//H)
-            return (None, None, None, None, gr, gk, gv, gw, gu)
+            gw = gw.view(H, C//H).to(torch.bfloat16)
+            gu = gu.view(H, C//H).to(torch.bfloat16)
+            return (None, None, None, None, gr, gk, gv, gw, gu, None, None)
+
+def RUN_CUDA_RWKV5(B, T, C, H, r, k, v, w, u, ew, eew):
+    return WKV_5.apply(B, T, C, H, r, k, v, w, u, ew, eew)
+
+# order of the fused projections in RWKV_TimeMix_RWKV5.kvrg / time_mix_kvrg
+KVRG_NAMES = ("key", "value", "receptance", "gate")
 
-def RUN_CUDA_RWKV5(B, T, C, H, r, k, v, w, u):
-    return WKV_5.apply(B, T, C, H, r, k, v, w, u)
+def time_shift_mix(x, mix):
+    # x * mix + time_shift(x) * (1 - mix), reading the previous token through a shifted view
+    # instead of materializing the zero-padded time_shift(x)
+    out = x * mix
+    out[..., 1:, :].addcmul_(x[:, :-1, :], 1 - mix)
+    return out
 
 ########################################################################################################
 
@@ -106,53 +120,54 @@ class RWKV_TimeMix_RWKV5(MyModule):
         with torch.no_grad():
             ratio_0_to_1 = layer_id / (args.n_layer - 1)  # 0 to 1
             ratio_1_to_almost0 = 1.0 - (layer_id / args.n_layer)  # 1 to ~0
-            ddd = torch.ones(1, 1, args.n_embd)
-            for i in range(args.n_embd):
-                ddd[0, 0, i] = i / args.n_embd
+            ddd = (torch.arange(args.n_embd) / args.n_embd).view(1, 1, args.n_embd)
 
-            # fancy time_mix
-            self.time_mix_k = nn.Parameter(torch.pow(ddd, ratio_1_to_almost0))
-            self.time_mix_v = nn.Parameter(torch.pow(ddd, ratio_1_to_almost0) + 0.3 * ratio_0_to_1)
-            self.time_mix_r = nn.Parameter(torch.pow(ddd, 0.5 * ratio_1_to_almost0))
-            self.time_mix_g = nn.Parameter(torch.pow(ddd, 0.5 * ratio_1_to_almost0))
+            # fancy time_mix, stacked as [k, v, r, g] -> (4, 1, 1, n_embd)
+            time_mix_k = torch.pow(ddd, ratio_1_to_almost0)
+            time_mix_v = torch.pow(ddd, ratio_1_to_almost0) + 0.3 * ratio_0_to_1
+            time_mix_r = torch.pow(ddd, 0.5 * ratio_1_to_almost0)
+            time_mix_g = torch.pow(ddd, 0.5 * ratio_1_to_almost0)
+            self.time_mix_kvrg = nn.Parameter(torch.stack([time_mix_k, time_mix_v, time_mix_r, time_mix_g]))
 
             # fancy time_decay
-            decay_speed = torch.ones(args.dim_att)
-            for n in range(args.dim_att):
-                decay_speed[n] = -6 + 5 * (n / (args.dim_att - 1)) ** (0.7 + 1.3 * ratio_0_to_1)
+            n = torch.arange(args.dim_att)
+            decay_speed = -6 + 5 * (n / (args.dim_att - 1)) ** (0.7 + 1.3 * ratio_0_to_1)
             self.time_decay = nn.Parameter(decay_speed.reshape(self.n_head, self.head_size))
             # print(layer_id, self.time_decay.flatten()[:3].cpu().numpy(), '...', self.time_decay.flatten()[-3:].cpu().numpy())
 
-            tmp = torch.zeros(args.dim_att)
-            for n in range(args.dim_att):
-                zigzag = ((n + 1) % 3 - 1) * 0.1
-                tmp[n] = ratio_0_to_1 * (1 - (n / (args.dim_att - 1))) + zigzag
+            zigzag = ((n + 1) % 3 - 1) * 0.1
+            tmp = ratio_0_to_1 * (1 - (n / (args.dim_att - 1))) + zigzag
 
             self.time_faaaa = nn.Parameter(tmp.reshape(self.n_head, self.head_size))
 
-        self.time_shift = nn.ZeroPad2d((0, 0, 1, -1))
-        self.receptance = nn.Linear(args.n_embd, args.dim_att, bias=False)
-        self.key = nn.Linear(args.n_embd, args.dim_att, bias=False)
+        # key, value, receptance and gate weights concatenated along the output dim
+        self.kvrg = nn.Linear(args.n_embd, 4 * args.dim_att, bias=False)
 
-        self.value = nn.Linear(args.n_embd, args.dim_att, bias=False)
         self.output = nn.Linear(args.dim_att, args.n_embd, bias=False)
-        self.gate = nn.Linear(args.n_embd, args.dim_att, bias=False)
-        self.ln_x = nn.GroupNorm(self.n_head, args.dim_att)
+        # GroupNorm(x / head_size_divisor, eps) == GroupNorm(x, eps * head_size_divisor**2)
+        self.ln_x = nn.GroupNorm(self.n_head, args.dim_att, eps=(1e-5)*(args.head_size_divisor**2))
+        self._decay_cache = None # (version of time_decay, ew, eew), only used when not training
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # fuse checkpoints that store key/value/receptance/gate separately (e.g. pretrained RWKV)
+        if prefix + "key.weight" in state_dict:
+            state_dict[prefix + "kvrg.weight"] = torch.cat(
+                [state_dict.pop(prefix + f"{name}.weight") for name in KVRG_NAMES])
+        if prefix + "time_mix_k" in state_dict:
+            state_dict[prefix + "time_mix_kvrg"] = torch.stack(
+                [state_dict.pop(prefix + f"time_mix_{name[0]}") for name in KVRG_NAMES])
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     @MyFunction
     def jit_func(self, x):
         B, T, C = x.size()
 
-        xx = self.time_shift(x) # Mix x with the previous timestep to produce xk, xv, xr
-        xk = x * self.time_mix_k + xx * (1 - self.time_mix_k)
-        xv = x * self.time_mix_v + xx * (1 - self.time_mix_v)
-        xr = x * self.time_mix_r + xx * (1 - self.time_mix_r)
-        xg = x * self.time_mix_g + xx * (1 - self.time_mix_g)
+        xkvrg = time_shift_mix(x, self.time_mix_kvrg) # Mix x with the previous timestep to produce xk, xv, xr, xg: [4, B, T, C]
 
-        r = self.receptance(xr)
-        k = self.key(xk)
-        v = self.value(xv)
-        g = F.silu(self.gate(xg))
+        # one batched GEMM instead of four Linear calls
+        kvrg = torch.bmm(xkvrg.view(4, B * T, C), self.kvrg.weight.view(4, -1, C).transpose(1, 2))
+        k, v, r, g = kvrg.view(4, B, T, -1).unbind(0)
+        g = F.silu(g)
 
         return r, k, v, g
 
@@ -161,20 +176,64 @@ class RWKV_TimeMix_RWKV5(MyModule):
         B, T, C = x.size()
         x = x.view(B * T, C)
         
-        x = self.ln_x(x / self.head_size_divisor).view(B, T, C)
+        x = self.ln_x(x).view(B, T, C)
         x = self.output(x * g)
         return x
 
+    def get_decay(self):
+        # ew = -exp(time_decay), eew = exp(ew) in fp32 for the kernel
+        # time_decay is fixed outside of training, so compute them once there
+        w = self.time_decay
+        version = (w.data_ptr(), w._version)
+        if not self.training and self._decay_cache is not None and self._decay_cache[0] == version:
+            return self._decay_cache[1], self._decay_cache[2]
+        with torch.no_grad():
+            ew = (-torch.exp(w.float())).contiguous()
+            eew = (torch.exp(ew)).contiguous()
+        # optimizers under deepspeed update .data without bumping the version, so never cache while training
+        self._decay_cache = None if self.training else (version, ew, eew)
+        return ew, eew
+
     def forward(self, x):
         B, T, C = x.size()
         H = self.n_head
 
         r, k, v, g = self.jit_func(x)
 
-        x = RUN_CUDA_RWKV5(B, T, C, H, r, k, v, w=self.time_decay, u=self.time_faaaa)
+        ew, eew = self.get_decay()
+        x = RUN_CUDA_RWKV5(B, T, C, H, r, k, v, w=self.time_decay, u=self.time_faaaa, ew=ew, eew=eew)
 
         return self.jit_func_2(x, g)
 
+    def forward_with_state(self, x, x_prev, wkv_state):
+        # x: [B, T, C] following the tokens already in the state
+        # x_prev: [B, C] input of the previous token, wkv_state: [B, H, N, N] in fp32
+        B, T, C = x.size()
+        H, N = self.n_head, self.head_size
+
+        xkvrg = time_shift_mix(x, self.time_mix_kvrg)
+        xkvrg[:, :, 0, :].addcmul_(x_prev, 1 - self.time_mix_kvrg[:, :, 0, :]) # the first token mixes with x_prev
+        kvrg = torch.bmm(xkvrg.view(4, B * T, C), self.kvrg.weight.view(4, -1, C).transpose(1, 2))
+        k, v, r, g = kvrg.view(4, B, T, -1).unbind(0)
+        g = F.silu(g)
+
+        ew, eew = self.get_decay()
+        if T > 1: # prompt, the cuda kernel starts from an empty state
+            y = RUN_CUDA_RWKV5(B, T, C, H, r, k, v, w=self.time_decay, u=self.time_faaaa, ew=ew, eew=eew)
+            y = y.float().view(B, T, H, N)
+        r, k, v = r.float().view(B, T, H, N), k.float().view(B, T, H, N), v.float().view(B, T, H, N)
+        if T == 1: # one token: y_i = sum_j r_j * u_j * k_j * v_i
+            y = (r * self.time_faaaa.float() * k).sum(dim=-1, keepdim=True) * v
+        # add what the tokens read from wkv_state, which decays by w = exp(-exp(time_decay)) per token
+        w = eew.view(H, N).unsqueeze(-1) ** torch.arange(T + 1, device=x.device) # [H, N, T + 1]: w^0 .. w^T
+        w = w.permute(2, 0, 1) # [T + 1, H, N]
+        y = y + torch.einsum('bthj,bhji->bthi', r * w[:T], wkv_state)
+        # the state after the last token
+        wkv_state = torch.einsum('bthj,bthi->bhji', k * w[:T].flip(0), v) + w[T].unsqueeze(-1) * wkv_state
+
+        x_prev = x[:, -1, :].clone()
+        return self.jit_func_2(y.view(B, T, C).to(x.dtype), g), x_prev, wkv_state
+
 ########################################################################################################
 
 class RWKV_ChannelMix(MyModule):
@@ -182,13 +241,10 @@ class RWKV_ChannelMix(MyModule):
         super().__init__()
         self.args = args
         self.layer_id = layer_id
-        self.time_shift = nn.ZeroPad2d((0, 0, 1, -1))
 
         with torch.no_grad():  # fancy init of time_mix
             ratio_1_to_almost0 = 1.0 - (layer_id / args.n_layer)  # 1 to ~0
-            ddd = torch.ones(1, 1, args.n_embd)
-            for i in range(args.n_embd):
-                ddd[0, 0, i] = i / args.n_embd
+            ddd = (torch.arange(args.n_embd) / args.n_embd).view(1, 1, args.n_embd)
             self.time_mix_k = nn.Parameter(torch.pow(ddd, ratio_1_to_almost0))
             self.time_mix_r = nn.Parameter(torch.pow(ddd, ratio_1_to_almost0))
         
@@ -198,14 +254,23 @@ class RWKV_ChannelMix(MyModule):
 
     @MyFunction
     def forward(self, x):
-        xx = self.time_shift(x)
-        xk = x * self.time_mix_k + xx * (1 - self.time_mix_k)
-        xr = x * self.time_mix_r + xx * (1 - self.time_mix_r)
+        xk, xr = time_shift_mix(x, torch.stack([self.time_mix_k, self.time_mix_r])).unbind(0)
         k = self.key(xk)
         k = torch.relu(k) ** 2
         kv = self.value(k)
         return torch.sigmoid(self.receptance(xr)) * kv
 
+    def forward_with_state(self, x, x_prev):
+        # x: [B, T, C] following the tokens already in the state, x_prev: [B, C] input of the previous token
+        mix = torch.stack([self.time_mix_k, self.time_mix_r])
+        xkr = time_shift_mix(x, mix)
+        xkr[:, :, 0, :].addcmul_(x_prev, 1 - mix[:, :, 0, :]) # the first token mixes with x_prev
+        xk, xr = xkr.unbind(0)
+        k = self.key(xk)
+        k = torch.relu(k) ** 2
+        kv = self.value(k)
+        return torch.sigmoid(self.receptance(xr)) * kv, x[:, -1, :].clone()
+
 ########################################################################################################
 # The RWKV Model with our blocks
 ########################################################################################################
@@ -234,27 +299,51 @@ class Block(nn.Module):
             self.drop0 = nn.Dropout(p = args.dropout)
             self.drop1 = nn.Dropout(p = args.dropout)
         
+    def _att_half(self, x):
+        if self.layer_id == 0 and self.args.pre_ffn > 0:
+            x = x + self.ffnPre(self.ln1(x))
+        else:
+            x = x + self.att(self.ln1(x))
+        if self.args.dropout > 0:
+            x = self.drop0(x)
+        return x
+
+    def _ffn_half(self, x):
+        x = x + self.ffn(self.ln2(x))
+        if self.args.dropout > 0:
+            x = self.drop1(x)
+        return x
+
     def forward(self, x):
         args = self.args
-        B, T, C = x.size()
         if self.layer_id == 0:
             x = self.ln0(x)
 
-        if self.args.dropout == 0:
-            if self.layer_id == 0 and args.pre_ffn > 0:
-                x = x + self.ffnPre(self.ln1(x))
-            else:
-                x = x + self.att(self.ln1(x))
-            x = x + self.ffn(self.ln2(x))
+        # grad_cp 1: recompute att and ffn separately, grad_cp 2: only recompute ffn (keep the wkv activations)
+        if args.grad_cp == 1:
+            x = deepspeed.checkpointing.checkpoint(self._att_half, x)
         else:
-            if self.layer_id == 0 and args.pre_ffn > 0:
-                x = self.drop0(x + self.ffnPre(self.ln1(x)))
-            else:
-                x = self.drop0(x + self.att(self.ln1(x)))
-            x = self.drop1(x + self.ffn(self.ln2(x)))
+            x = self._att_half(x)
+        if args.grad_cp > 0:
+            x = deepspeed.checkpointing.checkpoint(self._ffn_half, x)
+        else:
+            x = self._ffn_half(x)
 
         return x
 
+    def forward_with_state(self, x, state):
+        # for generation, state of this layer: [att x_prev, att wkv state, ffn x_prev], replaced in place
+        if self.layer_id == 0:
+            x = self.ln0(x)
+
+        if self.layer_id == 0 and self.args.pre_ffn > 0:
+            dx, state[0] = self.ffnPre.forward_with_state(self.ln1(x), state[0])
+        else:
+            dx, state[0], state[1] = self.att.forward_with_state(self.ln1(x), state[0], state[1])
+        x = x + dx
+        dx, state[2] = self.ffn.forward_with_state(self.ln2(x), state[2])
+        return x + dx
+
 
 class L2Wrap(torch.autograd.Function):
     @staticmethod
@@ -266,10 +355,14 @@ class L2Wrap(torch.autograd.Function):
     def backward(ctx, grad_output):
         y = ctx.saved_tensors[0]
         # to encourage the logits to be close to 0
-        factor = 1e-4 / (y.shape[0] * y.shape[1])
-        maxx, ids = torch.max(y, -1, keepdim=True)
-        gy = torch.zeros_like(y)
-        gy.scatter_(-1, ids, maxx * factor)
+        B, T, V = y.shape
+        factor = 1e-4 / (B * T)
+        maxx, ids = torch.max(y, -1)
+        # only one value per token is non-zero, so return a sparse gradient instead of a dense [B, T, V] one,
+        # autograd adds it into the dense gradient coming from the loss
+        b, t = torch.meshgrid(torch.arange(B, device=y.device), torch.arange(T, device=y.device), indexing="ij")
+        indices = torch.stack([b.flatten(), t.flatten(), ids.flatten()])
+        gy = torch.sparse_coo_tensor(indices, (maxx * factor).flatten(), y.shape)
         return (grad_output, gy)
 
 
@@ -307,10 +400,25 @@ class RWKV(pl.LightningModule):
             x = self.drop0(x)
 
         for block in self.blocks:
-            if args.grad_cp == 1:
-                x = deepspeed.checkpointing.checkpoint(block, x)
-            else:
-                x = block(x)
+            x = block(x) # gradient checkpointing is done inside the block
+
+        x = self.ln_out(x)
+
+        x = self.head(x)
+
+        return x
+
+    def empty_state(self, B, device, dtype):
+        args = self.args
+        H, N = args.dim_att // args.head_size_a, args.head_size_a
+        return [[torch.zeros((B, args.n_embd), device=device, dtype=dtype),
+                 torch.zeros((B, H, N, N), device=device, dtype=torch.float32),
+                 torch.zeros((B, args.n_embd), device=device, dtype=dtype)] for _ in range(args.n_layer)]
+
+    def forward_with_state(self, x, state):
+        # x: [B, T, n_embd] embeddings of the tokens after the ones in state, state is updated in place
+        for block, block_state in zip(self.blocks, state):
+            x = block.forward_with_state(x, block_state)
 
         x = self.ln_out(x)
 
@@ -336,24 +444,50 @@ class VisualRWKV(pl.LightningModule):
         super().__init__()
         self.args = args
         self.rwkv = RWKV(args)
+        self.graphed_blocks = {} # input shape -> cuda graphed block stack, see blocks_forward
         if len(args.load_model) > 0:
             self.load_rwkv_from_pretrained(args.load_model)
         if args.vision_tower_name == "dummy":
             configuration = CLIPVisionConfig()
             self.vit = CLIPVisionModel(configuration)
         else:
-            self.vit = CLIPVisionModel.from_pretrained(args.vision_tower_name)
+            try: # fused attention (flash / memory efficient) through torch sdpa
+                self.vit = CLIPVisionModel.from_pretrained(args.vision_tower_name, attn_implementation="sdpa")
+            except (TypeError, ValueError): # transformers without sdpa support for clip
+                self.vit = CLIPVisionModel.from_pretrained(args.vision_tower_name)
+            rank_zero_info(f"vit attention implementation: {getattr(self.vit.config, '_attn_implementation', 'eager')}")
         self.vit.requires_grad_(False)
+        if getattr(args, "compile_vit", 0):
+            # compile the forward only, so the state dict keys of the vit stay the same
+            self.vit.forward = torch.compile(self.vit.forward)
         self.proj = nn.Linear(self.vit.config.hidden_size, args.n_embd, bias=False)
+        if self.vit.config.hidden_size % 64 != 0 or args.n_embd % 64 != 0:
+            rank_zero_info(f"Note: vit hidden_size {self.vit.config.hidden_size} and n_embd {args.n_embd} should be multiples of 64 for the tensor core kernels of proj.")
+        if args.image_scanning in ('bidirection', 'multidirection'):
+            # image token order of each scanning direction, applied with a single gather:
+            # 0: as is, 1: reverse, 2: transpose, 3: transpose then reverse
+            # the side of the image token grid after grid_pooling, the stride is rounded down
+            # so an uneven grid_size gives more tokens than grid_size**2
+            grid = self.vit.config.image_size // self.vit.config.patch_size
+            if args.grid_size in (0, 1):
+                grid = args.grid_size
+            elif args.grid_size != -1:
+                grid = grid // (grid // args.grid_size)
+            order = torch.arange(grid * grid)
+            transposed = order.view(grid, grid).t().reshape(-1)
+            scan_orders = torch.stack([order, order.flip(0), transposed, transposed.flip(0)])
+            # scan_transitions[a, b]: from the tokens in scan order a to the same tokens in scan order b
+            self.register_buffer("scan_transitions", scan_orders.argsort(dim=1)[:, scan_orders], persistent=False)
+        # scan orders are built once here and moved with the model, but not saved in checkpoints
         if args.image_scanning == 'spiral':
             spiral_order = get_spiral_scan_order(self.vit.config.image_size//self.vit.config.patch_size)
-            self.register_buffer("spiral_order", torch.LongTensor(spiral_order))
+            self.register_buffer("spiral_order", torch.LongTensor(spiral_order), persistent=False)
         if args.image_scanning == 'snake':
             snake_order = get_snake_scan_order(self.vit.config.image_size//self.vit.config.patch_size)
-            self.register_buffer("snake_order", torch.LongTensor(snake_order))
+            self.register_buffer("snake_order", torch.LongTensor(snake_order), persistent=False)
         if args.image_scanning == 'zigzag':
             zigzag_order = get_zigzag_scan_order(self.vit.config.image_size//self.vit.config.patch_size)
-            self.register_buffer("zigzag_order", torch.LongTensor(zigzag_order))
+            self.register_buffer("zigzag_order", torch.LongTensor(zigzag_order), persistent=False)
 
     def load_rwkv_from_pretrained(self, path):
         self.rwkv.load_state_dict(torch.load(path, map_location="cpu"))
@@ -385,6 +519,20 @@ class VisualRWKV(pl.LightningModule):
         else:
             self.rwkv.emb.requires_grad_(False)
 
+    def quantize_vit(self):
+        # int8 weight-only quantization of the frozen vit, for inference
+        if not importlib.util.find_spec('torchao'):
+            raise ImportError("quantize_vit requires torchao, try `pip install torchao`")
+        quantize_(self.vit, int8_weight_only())
+
+    @torch.no_grad()
+    def quantize_decode_emb(self):
+        # int8 copy of the rwkv embedding with a scale per row, only read by the decode steps of generate
+        weight = self.rwkv.emb.weight.float()
+        scale = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+        self.register_buffer("emb_q", torch.round(weight / scale.unsqueeze(1)).to(torch.int8), persistent=False)
+        self.register_buffer("emb_scale", scale.to(self.rwkv.emb.weight.dtype), persistent=False)
+
     def freeze_proj(self):
         self.proj.requires_grad_(False)
 
@@ -399,91 +547,52 @@ class VisualRWKV(pl.LightningModule):
         return FusedAdam(optim_groups, lr=self.args.lr_init, betas=self.args.betas, eps=self.args.adam_eps, bias_correction=True, adam_w_mode=True, amsgrad=False)
 
     def forward(self, samples):
-        x, targets, image_features = self.preparing_embedding(samples)
-        if self.args.image_scanning == 'unidirection':
-            logits = self.unidirectional_forward(x, x_emb=image_features)
-        if self.args.image_scanning == 'bidirection':
-            logits = self.bidirectional_forward(x, x_emb=image_features)
-        if self.args.image_scanning == 'multidirection':
-            logits = self.multidirectional_forward(x, x_emb=image_features)
-        if self.args.image_scanning == 'rotation':
-            logits = self.rotational_forward(x, x_emb=image_features)
-        if self.args.image_scanning == 'spiral':
-            logits = self.spiral_forward(x, x_emb=image_features)
-        if self.args.image_scanning == 'snake':
-            logits = self.snake_forward(x, x_emb=image_features)
-        if self.args.image_scanning == 'zigzag':
-            logits = self.zigzag_forward(x, x_emb=image_features)
+        scanning_forward = self.get_scanning_forward()
+        # spiral, snake and zigzag only change the order of the image tokens, which is done while embedding
+        order = getattr(self, f"{self.args.image_scanning}_order", None)
+        x, targets, image_features = self.preparing_embedding(samples, order=order)
+        logits = scanning_forward(x, x_emb=image_features)
         return logits, targets
     
-    def unidirectional_forward(self, x, x_emb=None):
+    def get_scanning_forward(self):
+        scanning_forwards = {
+            'unidirection': self.unidirectional_forward,
+            'bidirection': self.bidirectional_forward,
+            'multidirection': self.multidirectional_forward,
+            'rotation': self.rotational_forward,
+            'spiral': self.unidirectional_forward,
+            'snake': self.unidirectional_forward,
+            'zigzag': self.unidirectional_forward,
+        }
+        if self.args.image_scanning not in scanning_forwards:
+            raise ValueError(f"Unknown image_scanning: {self.args.image_scanning}, should be one of {list(scanning_forwards)}.")
+        return scanning_forwards[self.args.image_scanning]
+    
+    def blocks_forward(self, x, state=None):
         args = self.args
-
-        if args.dropout > 0:
-            x = self.rwkv.drop0(x)
-
+        if state is not None: # prefill of generate
+            for block, block_state in zip(self.rwkv.blocks, state):
+                x = block.forward_with_state(x, block_state)
+            return x
+        # with static shapes, replay all blocks as one cuda graph to skip the per-kernel launch overhead
+        # graph capture cannot replay deepspeed checkpointing, so only without grad_cp
+        if getattr(args, "use_cuda_graph", 0) and args.grad_cp == 0 and self.training and torch.is_grad_enabled():
+            key = (x.shape, x.dtype, x.device, x.requires_grad)
+            if key not in self.graphed_blocks:
+                sample_x = x.detach().clone().requires_grad_(x.requires_grad)
+                self.graphed_blocks[key] = torch.cuda.make_graphed_callables(nn.Sequential(*self.rwkv.blocks), (sample_x,))
+            return self.graphed_blocks[key](x)
         for block in self.rwkv.blocks:
-            if args.grad_cp == 1:
-                x = deepspeed.checkpointing.checkpoint(block, x)
-            else:
-                x = block(x)
-
-        x = self.rwkv.ln_out(x)
-
-        x = self.rwkv.head(x)
-
+            x = block(x)
         return x
-    
-    def bidirectional_forward(self, x, x_emb=None):
-        args = self.args
 
-        if args.dropout > 0:
-            x = self.rwkv.drop0(x)
-
-        for i, block in enumerate(self.rwkv.blocks):
-            do_reverse = (i % 2 == 1)
-            if do_reverse: # reverse
-                x[:, self.img_start:self.img_end, :] = x[:, self.img_start:self.img_end, :].flip(1)
-            
-            if args.grad_cp == 1:
-                x = deepspeed.checkpointing.checkpoint(block, x)
-            else:
-                x = block(x)
-            
-            if do_reverse: # reverse back
-                x[:, self.img_start:self.img_end, :] = x[:, self.img_start:self.img_end, :].flip(1)
-
-        x = self.rwkv.ln_out(x)
-
-        x = self.rwkv.head(x)
-
-        return x
-    
-    def multidirectional_forward(self, x, x_emb=None):
+    def unidirectional_forward(self, x, x_emb=None, state=None):
         args = self.args
-        B, T, C = x.size()
-        H = W = int((self.img_end-self.img_start)**0.5)
 
         if args.dropout > 0:
             x = self.rwkv.drop0(x)
 
-        for i, block in enumerate(self.rwkv.blocks):
-            do_transpose = (i % 4 >=2) 
-            if do_transpose: # transpose
-                x[:, self.img_start:self.img_end, :] = x[:, self.img_start:self.img_end, :].view(B, H, W, C).transpose(1, 2).contiguous().view(B, H*W, C)
-            do_reverse = (i % 2 == 1)
-            if do_reverse: # reverse
-                x[:, self.img_start:self.img_end, :] = x[:, self.img_start:self.img_end, :].flip(1)
-            
-            if args.grad_cp == 1:
-                x = deepspeed.checkpointing.checkpoint(block, x)
-            else:
-                x = block(x)
-            
-            if do_reverse: # reverse back
-                x[:, self.img_start:self.img_end, :] = x[:, self.img_start:self.img_end, :].flip(1)
-            if do_transpose: # transpose back
-                x[:, self.img_start:self.img_end, :] = x[:, self.img_start:self.img_end, :].view(B, H, W, C).transpose(1, 2).contiguous().view(B, H*W, C)
+        x = self.blocks_forward(x, state)
 
         x = self.rwkv.ln_out(x)
 
@@ -491,20 +600,13 @@ class VisualRWKV(pl.LightningModule):
 
         return x
     
-    def rotational_forward(self, x, x_emb=None):
+    def bidirectional_forward(self, x, x_emb=None, state=None):
         args = self.args
 
-        rotate_distance = (self.img_end - self.img_start) // 3
         if args.dropout > 0:
             x = self.rwkv.drop0(x)
 
-        for i, block in enumerate(self.rwkv.blocks):
-            if args.grad_cp == 1:
-                x = deepspeed.checkpointing.checkpoint(block, x)
-            else:
-                x = block(x)
-            # rotate
-            x[:, self.img_start:self.img_end, :] = rotate_tensor(x[:, self.img_start:self.img_end, :], rotate_distance)
+        x = self.scanning_blocks_forward(x, num_scan_orders=2, state=state) # forward, reverse
 
         x = self.rwkv.ln_out(x)
 
@@ -512,19 +614,13 @@ class VisualRWKV(pl.LightningModule):
 
         return x
     
-    def spiral_forward(self, x, x_emb=None):
+    def multidirectional_forward(self, x, x_emb=None, state=None):
         args = self.args
-        spiral_image_features = x_emb[:, :-1][:, self.spiral_order]
-        x[:, self.img_start:self.img_end, :] = spiral_image_features
 
         if args.dropout > 0:
             x = self.rwkv.drop0(x)
 
-        for block in self.rwkv.blocks:
-            if args.grad_cp == 1:
-                x = deepspeed.checkpointing.checkpoint(block, x)
-            else:
-                x = block(x)
+        x = self.scanning_blocks_forward(x, num_scan_orders=4, state=state) # forward, reverse, transpose, transpose then reverse
 
         x = self.rwkv.ln_out(x)
 
@@ -532,39 +628,34 @@ class VisualRWKV(pl.LightningModule):
 
         return x
     
-    def snake_forward(self, x, x_emb=None):
-        args = self.args
-        snake_image_features = x_emb[:, :-1][:, self.snake_order]
-        x[:, self.img_start:self.img_end, :] = snake_image_features
-
-        if args.dropout > 0:
-            x = self.rwkv.drop0(x)
-
-        for block in self.rwkv.blocks:
-            if args.grad_cp == 1:
-                x = deepspeed.checkpointing.checkpoint(block, x)
-            else:
-                x = block(x)
-
-        x = self.rwkv.ln_out(x)
-
-        x = self.rwkv.head(x)
+    def scanning_blocks_forward(self, x, num_scan_orders, state=None):
+        # block i scans the image tokens in scan order i % num_scan_orders, see scan_transitions
+        # the tokens go directly from the order of one block to the order of the next,
+        # instead of being restored to the original order after every block
+        scan = 0
+        for i, block in enumerate(self.rwkv.blocks):
+            next_scan = i % num_scan_orders
+            if next_scan != scan: # one gather
+                x[:, self.img_start:self.img_end, :] = x[:, self.img_start:self.img_end, :].index_select(1, self.scan_transitions[scan, next_scan])
+                scan = next_scan
+            
+            x = block(x) if state is None else block.forward_with_state(x, state[i])
 
+        if scan != 0: # back to the original order
+            x[:, self.img_start:self.img_end, :] = x[:, self.img_start:self.img_end, :].index_select(1, self.scan_transitions[scan, 0])
         return x
     
-    def zigzag_forward(self, x, x_emb=None):
+    def rotational_forward(self, x, x_emb=None, state=None):
         args = self.args
-        zigzag_image_features = x_emb[:, :-1][:, self.zigzag_order]
-        x[:, self.img_start:self.img_end, :] = zigzag_image_features
 
+        rotate_distance = (self.img_end - self.img_start) // 3
         if args.dropout > 0:
             x = self.rwkv.drop0(x)
 
-        for block in self.rwkv.blocks:
-            if args.grad_cp == 1:
-                x = deepspeed.checkpointing.checkpoint(block, x)
-            else:
-                x = block(x)
+        for i, block in enumerate(self.rwkv.blocks):
+            x = block(x) if state is None else block.forward_with_state(x, state[i])
+            # rotate
+            x[:, self.img_start:self.img_end, :] = rotate_tensor(x[:, self.img_start:self.img_end, :], rotate_distance)
 
         x = self.rwkv.ln_out(x)
 
@@ -586,120 +677,109 @@ class VisualRWKV(pl.LightningModule):
             if self.trainer.is_global_zero:
                 self.trainer.my_loss_all = all
     
-    def encode_images(self, images):
+    def encode_images(self, images, has_image=None):
         B, N, C, H, W = images.shape
-        images = images.view(B*N, C, H, W)
-        image_features = self.vit(images).last_hidden_state
-        L, D = image_features.shape[1], image_features.shape[2]
-        # rerange [B*N, L, D] -> [B, N, L, D]
-        image_features = image_features.view(B, N, L, D)[:, 0, :, :]
+        # only the first image of each sample is used, skip the vit for the others
+        images = images[:, 0, :, :, :]
+        with torch.no_grad(): # the vit is frozen
+            if has_image is None or has_image.all():
+                image_features = self.vit(images).last_hidden_state
+            else:
+                # samples without an image get all-zero features, so only run the vit on the rest
+                L = (self.vit.config.image_size // self.vit.config.patch_size) ** 2 + 1 # with cls token
+                image_features = torch.zeros((B, L, self.vit.config.hidden_size), dtype=images.dtype, device=images.device)
+                active = torch.where(has_image)[0]
+                if active.numel() > 0:
+                    image_features[active] = self.vit(images[active]).last_hidden_state
         image_features = self.grid_pooling(image_features)
-        return self.proj(image_features)
+        # the vit may run in another precision (e.g. quantized or compiled), keep proj in its own dtype
+        return self.proj(image_features.to(self.proj.weight.dtype))
     
     def grid_pooling(self, image_features):
-        cls_features = image_features[:, 0:1, :]
-        image_features = image_features[:, 1:, :] #drop cls token
+        # the cls token stays in front, preparing_embedding moves it behind the image tokens
         if self.args.grid_size == -1: # no grid pooling
-            return torch.cat((image_features, cls_features), dim=1)
+            return image_features
+        cls_features = image_features[:, 0:1, :]
         if self.args.grid_size == 0: # take cls token
             return cls_features
+        image_features = image_features[:, 1:, :] #drop cls token
         if self.args.grid_size == 1: # global avg pooling
-            return torch.cat((image_features.mean(dim=1, keepdim=True), cls_features), dim=1)
+            return torch.cat((cls_features, image_features.mean(dim=1, keepdim=True)), dim=1)
         B, L, D = image_features.shape
         H_or_W = int(L**0.5)
         image_features = image_features.view(B, H_or_W, H_or_W, D)
         grid_stride = H_or_W // self.args.grid_size
+        # the permuted [B, D, H, W] view is channels last, so avg_pool2d reads it without a copy
         image_features = F.avg_pool2d(image_features.permute(0, 3, 1, 2), 
                                       padding=0,
                                       kernel_size=grid_stride, 
                                       stride=grid_stride)
-        image_features = image_features.permute(0, 2, 3, 1).view(B, -1, D)
-        return torch.cat((image_features, cls_features), dim=1)
+        image_features = image_features.permute(0, 2, 3, 1).reshape(B, -1, D)
+        return torch.cat((cls_features, image_features), dim=1)
     
     def get_max_image_token_indice(self, samples):
-        max_image_token_indice = 0
-        for cur_input_ids in samples["input_ids"]:
-            num_images = (cur_input_ids == IMAGE_TOKEN_INDEX).sum()
-            if num_images == 1:
-                image_token_indice = torch.where(cur_input_ids == IMAGE_TOKEN_INDEX)[0][0]
-                max_image_token_indice = max(max_image_token_indice, image_token_indice)
-        return max_image_token_indice
+        is_image_token = (samples["input_ids"] == IMAGE_TOKEN_INDEX)
+        image_token_indice = is_image_token.int().argmax(dim=1)
+        # only samples with exactly one image count
+        image_token_indice = image_token_indice.masked_fill(is_image_token.sum(dim=1) != 1, 0)
+        return image_token_indice.max().item()
     
-    def truncate_input(self, new_input_embeds, new_labels):
-        # prioritize retaining the labels at the beginning
-        # if there are no valid labels at the beginning, retain the labels from the end
-        truncated_input_embeds = []
-        truncated_labels = []
-        for x, y in zip(new_input_embeds, new_labels):
-            valid_labels = [i for i in y[:self.args.ctx_len] if i != IGNORE_INDEX]
-            if valid_labels:
-                truncated_input_embeds.append(x[:self.args.ctx_len])
-                truncated_labels.append(y[:self.args.ctx_len])
-            else:
-                truncated_input_embeds.append(x[-self.args.ctx_len:])
-                truncated_labels.append(y[-self.args.ctx_len:])
-        return truncated_input_embeds, truncated_labels
-   
-    def preparing_embedding(self, samples, truncate=True):
-        device, label_dtype = samples["labels"].device, samples["labels"].dtype
-        emb_dtype = samples["images"].dtype
+    def preparing_embedding(self, samples, truncate=True, order=None):
+        # order: optional scan order of the image tokens (cls token excluded)
+        input_ids, labels = samples["input_ids"], samples["labels"]
+        device, emb_dtype = input_ids.device, samples["images"].dtype
+        B, S = input_ids.shape
+        is_image_token = (input_ids == IMAGE_TOKEN_INDEX)
+        num_images = is_image_token.sum(dim=1)
+        if (num_images > 1).any():
+            raise ValueError(f"Too many images in one sample: {num_images.max().item()}, should be 0 or 1.")
+        has_image = (num_images == 1)
         ### prepare image features
-        image_features  = self.encode_images(samples["images"]) # with cls token
+        image_features  = self.encode_images(samples["images"], has_image) # with cls token in front
+        L = image_features.shape[1]
         ### prepare input token
-        new_input_embeds = []
-        new_labels = []
         max_image_token_indice = self.get_max_image_token_indice(samples)
         self.img_start = max_image_token_indice
-        self.img_end = max_image_token_indice + (image_features.shape[1] - 1) # exclude cls token
-        for idx, cur_input_ids in enumerate(samples["input_ids"]):
-            cur_labels = samples["labels"][idx]
-            cur_new_input_ids = torch.zeros(max_image_token_indice, dtype=cur_input_ids.dtype, device=device)
-            cur_new_labels = torch.full((max_image_token_indice,), IGNORE_INDEX, device=device, dtype=label_dtype)
-            num_images = (cur_input_ids == IMAGE_TOKEN_INDEX).sum()
-            if num_images == 0: # no image in this sample
-                # mask image feature, set to 0
-                image_features[idx] = torch.zeros_like(image_features[idx])
-            elif num_images == 1: # only one image in this sample
-                image_token_indice = torch.where(cur_input_ids == IMAGE_TOKEN_INDEX)[0][0]
-                # first text part, left paded
-                cur_new_input_ids[-image_token_indice:] = cur_input_ids[:image_token_indice]
-                cur_new_labels[-image_token_indice:] = cur_labels[:image_token_indice]
-            else:
-                raise ValueError(f"Too many images in one sample: {num_images}, should be 0 or 1.")
-            # convert to list
-            cur_new_input_embeds = [self.rwkv.emb(cur_new_input_ids)]
-            cur_new_labels = [cur_new_labels]
-            # image part
-            cur_image_features = image_features[idx]
-            cur_new_input_embeds.append(cur_image_features)
-            cur_new_labels.append(torch.full((cur_image_features.shape[0],), IGNORE_INDEX, device=device, dtype=label_dtype))
-            # last text part
-            if num_images == 1:
-                cur_new_input_embeds.append(self.rwkv.emb(cur_input_ids[image_token_indice+1:]))
-                cur_new_labels.append(cur_labels[image_token_indice+1:])
-            else: # no image
-                cur_new_input_embeds.append(self.rwkv.emb(cur_input_ids))
-                cur_new_labels.append(cur_labels)
-            # concat them
-            cur_new_input_embeds = torch.cat(cur_new_input_embeds)
-            cur_new_labels = torch.cat(cur_new_labels)
-
-            new_input_embeds.append(cur_new_input_embeds)
-            new_labels.append(cur_new_labels)
+        self.img_end = max_image_token_indice + (L - 1) # exclude cls token
+        # each row is [first text part left paded to max_image_token_indice, image, last text part],
+        # a sample without image has an empty first text part and keeps all its tokens in the last one
+        image_token_indice = is_image_token.int().argmax(dim=1, keepdim=True) # 0 if no image
+        last_text_start = image_token_indice + has_image.unsqueeze(1)
+        text_indices = torch.cat([torch.arange(-max_image_token_indice, 0, device=device) + image_token_indice,
+                                  torch.arange(S, device=device) + last_text_start], dim=1)
+        is_left_pad = (text_indices < 0)
+        is_right_pad = (text_indices >= S)
+        is_pad = is_left_pad | is_right_pad
+        text_indices = text_indices.clamp(0, S - 1)
+        # left padding is token 0, right padding is a zero vector like the final padding
+        text_embeds = self.rwkv.emb(input_ids.gather(1, text_indices).masked_fill(is_pad, 0))
+        text_embeds = text_embeds.masked_fill(is_right_pad.unsqueeze(-1), 0)
+        text_labels = labels.gather(1, text_indices).masked_fill(is_pad, IGNORE_INDEX)
+        image_tokens = image_features[:, 1:] if order is None else image_features[:, 1:].index_select(1, order)
+        # splice the image features in, for all samples at once
+        new_input_embeds = torch.cat([text_embeds[:, :max_image_token_indice], 
+                                      image_tokens,
+                                      image_features[:, :1], # cls token
+                                      text_embeds[:, max_image_token_indice:]], dim=1)
+        new_labels = torch.cat([text_labels[:, :max_image_token_indice],
+                                torch.full((B, L), IGNORE_INDEX, dtype=labels.dtype, device=device),
+                                text_labels[:, max_image_token_indice:]], dim=1)
+        new_len = max_image_token_indice + L + S - last_text_start.squeeze(1) # without padding
+        max_len = max_image_token_indice + L + S - last_text_start.min().item()
         # Truncate sequences to max length as image embeddings can make the sequence longer
-        # keep the first `ctx_len` tokens, to make sure instruction complete
-        if truncate:
-            new_input_embeds, new_labels = self.truncate_input(new_input_embeds, new_labels)
-        # Combine them
-        max_len = max(x.shape[0] for x in new_input_embeds)
-        batch_size = len(new_input_embeds)
-        new_input_embeds_padded = torch.zeros((batch_size, max_len, self.args.n_embd), dtype=emb_dtype, device=device)
-        new_labels_padded = torch.full((batch_size, max_len), IGNORE_INDEX, dtype=label_dtype, device=device)
-        for i, (cur_new_embed, cur_new_labels) in enumerate(zip(new_input_embeds, new_labels)):
-            cur_len = cur_new_embed.shape[0]
-            new_input_embeds_padded[i, :cur_len] = cur_new_embed
-            new_labels_padded[i, :cur_len] = cur_new_labels
-        return new_input_embeds_padded, new_labels_padded, image_features
+        # prioritize retaining the labels at the beginning, to make sure instruction complete
+        # if there are no valid labels at the beginning, retain the labels from the end
+        if truncate and max_len > self.args.ctx_len:
+            ctx_len = self.args.ctx_len
+            keep_head = (new_labels[:, :ctx_len] != IGNORE_INDEX).any(dim=1)
+            offset = torch.where(keep_head, 0, (new_len - ctx_len).clamp(min=0))
+            indices = offset.unsqueeze(1) + torch.arange(ctx_len, device=device)
+            new_input_embeds = new_input_embeds.gather(1, indices.unsqueeze(-1).expand(-1, -1, new_input_embeds.shape[-1]))
+            new_labels = new_labels.gather(1, indices)
+        else:
+            new_input_embeds = new_input_embeds[:, :max_len]
+            new_labels = new_labels[:, :max_len]
+        return new_input_embeds.to(emb_dtype), new_labels, image_features
     
     def generate(self, input_ids, images, do_sample, temperature, top_p, max_new_tokens, stop_token_idx) -> list[int]:
         ''' one mode to generate, only generate one sample at a time
@@ -710,30 +790,48 @@ class VisualRWKV(pl.LightningModule):
         # top_p: float
         # max_new_tokens: int
         '''
+        scanning_forward = self.get_scanning_forward()
         # prepare samples
         sampels = {"input_ids": input_ids, "images": images, "labels": torch.full_like(input_ids, IGNORE_INDEX)}
         # prepare embedding, x: [1, seq_len, n_embd]
-        x, _, image_features = self.preparing_embedding(sampels, truncate=False)
-        # generate
-        generated = []
+        order = getattr(self, f"{self.args.image_scanning}_order", None)
+        x, _, image_features = self.preparing_embedding(sampels, truncate=False, order=order)
+        # the prompt runs once and leaves the rwkv state of every layer,
+        # each new token then only updates the state, so there is no need to truncate to ctx_len
+        state = self.rwkv.empty_state(x.shape[0], x.device, x.dtype)
+        logits = scanning_forward(x, x_emb=image_features, state=state)
+        decode_step = self.rwkv.forward_with_state
+        if getattr(self.args, "compile_decode", 0):
+            # one token at a time has fixed shapes, compile it once and reuse it for every generate call
+            if getattr(self, "compiled_decode_step", None) is None:
+                self.compiled_decode_step = torch.compile(self.rwkv.forward_with_state, dynamic=False)
+            decode_step = self.compiled_decode_step
+        # generate, new tokens are written into a preallocated buffer on the device
+        tokens = torch.empty((x.shape[0], max_new_tokens), dtype=torch.long, device=x.device)
+        # reading a token back waits for the gpu, so only look for the stop token every few steps
+        stop_check_interval = 8
+        num_tokens = 0
         for i in range(max_new_tokens):
-            if self.args.image_scanning == 'unidirection':
-                logits = self.unidirectional_forward(x, x_emb=image_features)
-            if self.args.image_scanning == 'bidirection':
-                logits = self.bidirectional_forward(x, x_emb=image_features)
-            if self.args.image_scanning == 'multidirection':
-                logits = self.multidirectional_forward(x, x_emb=image_features)
-            next_logit = logits[:, -1, :]
+            if i > 0:
+                # index the embedding table directly, [1, 1] -> [1, 1, n_embd]
+                token = tokens[:, i-1:i]
+                if getattr(self, "emb_q", None) is not None:
+                    x = self.emb_q[token].to(self.emb_scale.dtype) * self.emb_scale[token].unsqueeze(-1)
+                else:
+                    x = self.rwkv.emb.weight[token]
+                logits = decode_step(x, state)
             if do_sample:
                 raise NotImplementedError
             else: # greedy
-                # [1, vocab_size] -> [1, 1]
-                next_token = torch.argmax(next_logit, dim=-1, keepdim=True)
-            generated.append(next_token.item())
-            if generated[-1] == stop_token_idx:
-                break
-            x = torch.cat((x, self.rwkv.emb(next_token)), dim=-2)
-            x = x[:, -self.args.ctx_len:, :] # truncate
+                # [vocab_size] -> 0-d tensor, stays on the device
+                tokens[0, i] = logits[0, -1].argmax()
+            num_tokens = i + 1
+            if num_tokens % stop_check_interval == 0:
+                if (tokens[0, num_tokens-stop_check_interval:num_tokens] == stop_token_idx).any():
+                    break
+        generated = tokens[0, :num_tokens].tolist()
+        if stop_token_idx in generated: # drop what was generated after the stop token
+            generated = generated[:generated.index(stop_token_idx) + 1]
         return generated
 
 
@@ -753,92 +851,41 @@ def rotate_tensor(tensor, distance):
     if distance == 0:
         return tensor
 
-    length = tensor.size(0)
-    distance = distance % length  # Ensure distance is within the length of the tensor
-
-    if distance < 0:
-        distance = length + distance  # Convert negative distance to positive equivalent
-
-    # Split tensor into two parts and concatenate them after rotation
-    rotated_tensor = torch.cat((tensor[-distance:], tensor[:-distance]))
+    # one gather kernel, handles negative distances and distances longer than the tensor
+    rotated_tensor = torch.roll(tensor, shifts=distance, dims=0)
 
     return rotated_tensor
 
+@functools.lru_cache(maxsize=None)
 def get_spiral_scan_order(n):
-    rows, cols = n, n
-    matrix = torch.arange(rows * cols).reshape(rows, cols).tolist()
-    order = list()
-    left, right, top, bottom = 0, cols - 1, 0, rows - 1
-    while left <= right and top <= bottom:
-        for column in range(left, right + 1):
-            order.append(matrix[top][column])
-        for row in range(top + 1, bottom + 1):
-            order.append(matrix[row][right])
-        if left < right and top < bottom:
-            for column in range(right - 1, left, -1):
-                order.append(matrix[bottom][column])
-            for row in range(bottom, top, -1):
-                order.append(matrix[row][left])
-        left, right, top, bottom = left + 1, right - 1, top + 1, bottom - 1
-    return order
+    # take the top row, then rotate what is left counterclockwise so its right column becomes the top row
+    matrix = torch.arange(n * n).reshape(n, n)
+    order = []
+    while matrix.numel() > 0:
+        order.append(matrix[0])
+        matrix = matrix[1:].rot90(1, (0, 1))
+    return tuple(torch.cat(order).tolist()) if order else ()
 
+@functools.lru_cache(maxsize=None)
 def get_snake_scan_order(n):
-    rows, cols = n, n
-    matrix = torch.arange(rows * cols).reshape(rows, cols).tolist()
-    order = list()
-    for i in range(rows):
-        if i % 2 == 0:
-            for j in range(cols):
-                order.append(matrix[i][j])
-        else:
-            for j in range(cols - 1, -1, -1):
-                order.append(matrix[i][j])
-    return order
+    matrix = torch.arange(n * n).reshape(n, n)
+    matrix[1::2] = matrix[1::2].flip(1) # odd rows go from right to left
+    return tuple(matrix.flatten().tolist())
 
+@functools.lru_cache(maxsize=None)
 def get_zigzag_scan_order(n):
     """
-    Perform zigzag scanning on a 2D matrix.
+    Zigzag scanning of a n x n grid: anti-diagonal by anti-diagonal, even ones going up, odd ones going down.
 
     Args:
-    - matrix (list of lists): Input 2D matrix to be scanned.
+    - n (int): Size of the grid.
 
     Returns:
-    - result (list): List containing elements scanned in zigzag order.
+    - order (tuple): Indices of the grid in zigzag order.
     """
-    rows, cols = n, n
-    matrix = torch.arange(rows * cols).reshape(rows, cols).tolist()
-    order = []
-    rows = len(matrix)
-    cols = len(matrix[0])
-
-    # Flag to indicate whether scanning upwards or downwards
-    going_up = True
-
-    for i in range(rows + cols - 1):
-        if going_up:
-            # If scanning upwards, start from the first row or the last column
-            if i < rows:
-                row, col = i, 0
-            else:
-                row, col = rows - 1, i - (rows - 1)
-            # Move diagonally upwards until reaching the first row or the last column
-            while row >= 0 and col < cols:
-                order.append(matrix[row][col])
-                row -= 1
-                col += 1
-        else:
-            # If scanning downwards, start from the last row or the first column
-            if i < cols:
-                row, col = 0, i
-            else:
-                row, col = i - (cols - 1), cols - 1
-            # Move diagonally downwards until reaching the last row or the first column
-            while row < rows and col >= 0:
-                order.append(matrix[row][col])
-                row += 1
-                col -= 1
-
-        # Change direction for the next diagonal scan
-        going_up = not going_up
-
-    return order
+    row = torch.arange(n).view(n, 1)
+    col = torch.arange(n).view(1, n)
+    diagonal = row + col
+    # sort by anti-diagonal, then by column going up or by row going down
+    key = diagonal * n + torch.where(diagonal % 2 == 0, col, row)
+    return tuple(key.flatten().argsort().tolist())
@@ -1,4 +1,4 @@
-import json, time, random, os
+import json, time, random, os, functools
 import numpy as np
 import dataclasses
 from torch.nn import functional as F
@@ -22,11 +22,40 @@ def load_image_from_base64(image):
     return Image.open(BytesIO(base64.b64decode(image)))
 
 
+def draft_image(image, image_processor, detail):
+    """
+    Let PIL decode a JPEG at 1/2, 1/4 or 1/8 scale, as long as both sides stay at least as large as
+    the preprocessing needs: the shortest edge of the processor, or 768px for gpt4v_crop.
+    Must be called before the image is loaded, does nothing for other formats.
+    """
+    min_size = 768 if detail == 'high' else image_processor.size["shortest_edge"]
+    image.draft(None, (min_size, min_size))
+    return image
+
+
+def load_image_processor(vision_tower_name, use_fast=False):
+    """
+    With use_fast, load the torchvision based fast image processor of the vision tower, which
+    resizes and normalizes all the images of a call (e.g. the 7 images of detail 'high') as one tensor.
+    Falls back to CLIPImageProcessor if this transformers has no fast processor for it.
+    """
+    from transformers import AutoImageProcessor, CLIPImageProcessor
+    if use_fast:
+        try:
+            return AutoImageProcessor.from_pretrained(vision_tower_name, use_fast=True)
+        except (ImportError, ValueError): # no torchvision or no fast processor
+            pass
+    return CLIPImageProcessor.from_pretrained(vision_tower_name)
+
+
+@functools.lru_cache(maxsize=None)
 def largest_3n_plus_2_prime(x):
     def is_prime(num):
         if num < 2:
             return False
-        for i in range(2, int(num ** 0.5) + 1):
+        if num % 2 == 0:
+            return num == 2
+        for i in range(3, int(num ** 0.5) + 1, 2): # odd divisors only
             if num % i == 0:
                 return False
         return True
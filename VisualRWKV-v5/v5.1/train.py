@@ -22,6 +22,7 @@ if __name__ == "__main__":
     parser.add_argument("--random_seed", default="-1", type=int)
 
     parser.add_argument("--data_file", default="", type=str)
+    parser.add_argument("--tokenized_dir", default="", type=str)  # output of pretokenize.py for data_file, "" to tokenize on the fly
     parser.add_argument("--data_type", default="utf-8", type=str)
     parser.add_argument("--vocab_size", default=0, type=int)  # vocab_size = 0 means auto (for char-level LM and .txt data)
 
@@ -46,7 +47,7 @@ if __name__ == "__main__":
     parser.add_argument("--beta1", default=0.9, type=float)
     parser.add_argument("--beta2", default=0.99, type=float)  # use 0.999 when your model is close to convergence
     parser.add_argument("--adam_eps", default=1e-8, type=float)
-    parser.add_argument("--grad_cp", default=0, type=int)  # gradient checkpt: saves VRAM, but slower
+    parser.add_argument("--grad_cp", default=0, type=int)  # gradient checkpt: saves VRAM, but slower (1: att and ffn, 2: ffn only)
     parser.add_argument("--dropout", default=0, type=float) # try 0.01 / 0.02 / 0.05 / 0.1
     parser.add_argument("--weight_decay", default=0, type=float) # try 0.1 / 0.01 / 0.001
     parser.add_argument("--weight_decay_final", default=-1, type=float)
@@ -54,6 +55,7 @@ if __name__ == "__main__":
 
     parser.add_argument("--vision_tower_name", default="openai/clip-vit-base-patch32", type=str)  # openai/clip-vit-base-patch32
     parser.add_argument("--image_folder", type=str, default="images")
+    parser.add_argument("--jpeg_draft", default=0, type=int)  # decode large jpegs at reduced resolution, see draft_image
     parser.add_argument("--grid_size", type=int, default=8) # -1 for no grid, 0 for cls token, 1 for global avg, 8 for 64 tokens
     parser.add_argument("--detail", type=str, default="low")
     parser.add_argument("--freeze_rwkv", default=0, type=int)  # layers to freeze
@@ -61,6 +63,9 @@ if __name__ == "__main__":
     parser.add_argument("--image_position", default='first', type=str)  # 'first' or 'last' or ''middle
     parser.add_argument("--image_scanning", default='unidirection', type=str, 
                         choices=['unidirection', 'bidirection', 'multidirection', 'spiral', 'snake', 'rotation', 'zigzag']) 
+    parser.add_argument("--compile_vit", default=0, type=int)  # torch.compile the frozen vit
+    parser.add_argument("--fast_image_processor", default=0, type=int)  # batched torchvision image preprocessing, see load_image_processor
+    parser.add_argument("--use_cuda_graph", default=0, type=int)  # replay the rwkv blocks as a cuda graph, needs grad_cp 0 and fixed shapes
 
     parser = Trainer.add_argparse_args(parser)
     args = parser.parse_args()
@@ -172,13 +177,14 @@ if __name__ == "__main__":
     from src.trainer import train_callback
     from src.dataset import MyDataset
     from src.rwkv_tokenizer import TRIE_TOKENIZER
+    from src.utils import load_image_processor
     from transformers import CLIPImageProcessor
 
     args.tokenizer = TRIE_TOKENIZER("src/rwkv_vocab_v20230424.txt")
     if args.vision_tower_name == 'dummy':
         args.image_processor = CLIPImageProcessor()
     else:
-        args.image_processor = CLIPImageProcessor.from_pretrained(args.vision_tower_name)
+        args.image_processor = load_image_processor(args.vision_tower_name, use_fast=args.fast_image_processor)
 
     train_data = MyDataset(args)
     args.vocab_size = train_data.vocab_size
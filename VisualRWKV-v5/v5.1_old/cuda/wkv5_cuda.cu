@@ -64,7 +64,7 @@ __global__ void kernel_forward(const int B, const int T, const int C, const int
 template <typename F>
 __global__ void kernel_backward(const int B, const int T, const int C, const int H,
     const F *__restrict__ const _r, const F *__restrict__ const _k, const F *__restrict__ const _v, const float *__restrict__ _w, const float *__restrict__ __w, const F *__restrict__ _u, const F *__restrict__ const _gy,
-    F *__restrict__ const _gr, F *__restrict__ const _gk, F *__restrict__ const _gv, F *__restrict__ const _gw, F *__restrict__ const _gu)
+    F *__restrict__ const _gr, F *__restrict__ const _gk, F *__restrict__ const _gv, float *__restrict__ const _gw, float *__restrict__ const _gu)
 {
     const int b = blockIdx.x / H;
     const int h = blockIdx.x % H;
@@ -114,7 +114,7 @@ __global__ void kernel_backward(const int B, const int T, const int C, const int
         _gr[t] = F(gr);
         gu += float(_r[t]) * gu_;
     }
-    _gu[b*C + h*_N_ + i] = F(gu);
+    atomicAdd(_gu + h*_N_ + i, gu); // summed over the batch
     
     for (int t = t000; t < t222; t += C)
     {
@@ -140,7 +140,7 @@ __global__ void kernel_backward(const int B, const int T, const int C, const int
         }
         gw += float(_r[t + 2*C]) * gw_;
     }    
-    _gw[b*C + h*_N_ + i] = F(ww * gw);
+    atomicAdd(_gw + h*_N_ + i, ww * gw); // summed over the batch
 
     for (int t = t111 - C; t >= t000; t -= C)
     {
@@ -194,7 +194,7 @@ void cuda_forward(int B, int T, int C, int H, bf16 *r, bf16 *k, bf16 *v, float *
     kernel_forward<<<dim3(B * H), dim3(_N_)>>>(B, T, C, H, r, k, v, w, u, y);
 }
 
-void cuda_backward(int B, int T, int C, int H, bf16 *r, bf16 *k, bf16 *v, float *w, float *ww, bf16 *u, bf16 *gy, bf16 *gr, bf16 *gk, bf16 *gv, bf16 *gw, bf16 *gu)
+void cuda_backward(int B, int T, int C, int H, bf16 *r, bf16 *k, bf16 *v, float *w, float *ww, bf16 *u, bf16 *gy, bf16 *gr, bf16 *gk, bf16 *gv, float *gw, float *gu)
 {
     assert(H*_N_ == C);
     assert(_N_%4 == 0);
@@ -136,6 +136,7 @@ def eval_model(args):
     msg = model.load_state_dict(state_dict, strict=False)
     print("msg of loading model: ", msg)
     model = model.bfloat16().to(args.device)
+    model.eval() # also lets the time mixes reuse their decay, see get_decay
     tokenizer = TRIE_TOKENIZER("src/rwkv_vocab_v20230424.txt")
     image_processor = CLIPImageProcessor.from_pretrained(args.vision_tower_name)
 
@@ -213,7 +214,7 @@ if __name__ == "__main__":
     parser.add_argument("--constraive_reduction", type=str, default='mean', choices=['mean', 'weighted']) # try 'mean' or 'weighted'
     parser.add_argument("--constraive_loss_weight", type=float, default=1.0) # try 0.1 / 0.2 / 0.5 / 1.0
     parser.add_argument("--detail", type=str, default="high")
-    parser.add_argument("--grad_cp", default=0, type=int)  # gradient checkpt: saves VRAM, but slower
+    parser.add_argument("--grad_cp", default=0, type=int)  # gradient checkpt: saves VRAM, but slower (1: whole block, 2: ffn only)
     # arguments for evaluation
     parser.add_argument("--model_path", type=str, default=None)
     parser.add_argument("--image_folder", type=str, default=None)
@@ -226,6 +227,7 @@ if __name__ == "__main__":
     parser.add_argument("--chunk_idx", type=int, default=0)
     parser.add_argument("--device", type=str, default="cuda")
     parser.add_argument("--dataset_name", type=str, default="default")
+    parser.add_argument("--compile_vit", default=0, type=int)  # torch.compile the frozen vit
     args = parser.parse_args()
     #
     os.environ["RWKV_HEAD_SIZE_A"] = str(args.head_size_a)
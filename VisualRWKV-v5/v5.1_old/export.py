@@ -20,6 +20,21 @@ for key in state_dict:
         rwkv_state_dict[key[5:]] = state_dict[key].half()
     else:
         visual_state_dict[key] = state_dict[key].half()
+# split the fused time-mix projections back into the standard rwkv layout
+kvrg_names = ("key", "value", "receptance", "gate")
+for key in [k for k in rwkv_state_dict if k.endswith("att.kvrg.weight")]:
+    prefix = key[:-len("kvrg.weight")]
+    for name, weight in zip(kvrg_names, rwkv_state_dict.pop(key).chunk(4, dim=0)):
+        rwkv_state_dict[prefix + f"{name}.weight"] = weight.clone()
+for key in [k for k in rwkv_state_dict if k.endswith("att.time_mix_kvrg")]:
+    prefix = key[:-len("time_mix_kvrg")]
+    for name, time_mix in zip(kvrg_names, rwkv_state_dict.pop(key).unbind(0)):
+        rwkv_state_dict[prefix + f"time_mix_{name[0]}"] = time_mix.clone()
+for key in [k for k in rwkv_state_dict if k.endswith("time_mix_kr")]:
+    prefix = key[:-len("time_mix_kr")]
+    time_mix_k, time_mix_r = rwkv_state_dict.pop(key).unbind(0)
+    rwkv_state_dict[prefix + "time_mix_k"] = time_mix_k.clone()
+    rwkv_state_dict[prefix + "time_mix_r"] = time_mix_r.clone()
 print("rwkv state dict has keys: ", len(rwkv_state_dict))
 print("visual state dict has keys: ", len(visual_state_dict))
 # save 
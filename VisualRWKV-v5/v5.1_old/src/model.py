@@ -2,12 +2,13 @@
 # The RWKV Language Model - https://github.com/BlinkDL/RWKV-LM
 ########################################################################################################
 
-import os, math, gc, importlib
+import os, math, gc, importlib, functools
 import torch
 # torch._C._jit_set_profiling_executor(True)
 # torch._C._jit_set_profiling_mode(True)
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 import pytorch_lightning as pl
 from pytorch_lightning.utilities import rank_zero_info, rank_zero_only
 from pytorch_lightning.strategies import DeepSpeedStrategy
@@ -37,12 +38,29 @@ if os.environ["RWKV_JIT_ON"] == "1":
 from torch.utils.cpp_extension import load
 
 HEAD_SIZE = int(os.environ["RWKV_HEAD_SIZE_A"])
-wkv5_cuda = load(name="wkv5", sources=["cuda/wkv5_op.cpp", f"cuda/wkv5_cuda.cu"],
-                verbose=True, extra_cuda_cflags=["-res-usage", "--use_fast_math", "-O3", "-Xptxas -O3", "--extra-device-vectorization", f"-D_N_={HEAD_SIZE}"])
+
+@functools.lru_cache(maxsize=None)
+def get_wkv5_cuda():
+    # built on first use instead of at import, rank 0 builds first and the other ranks load its build
+    distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+    if distributed and torch.distributed.get_rank() != 0:
+        torch.distributed.barrier()
+    wkv5_cuda = load(name="wkv5", sources=["cuda/wkv5_op.cpp", f"cuda/wkv5_cuda.cu"],
+                    verbose=True, extra_cuda_cflags=["-res-usage", "--use_fast_math", "-O3", "-Xptxas -O3", "--extra-device-vectorization", f"-D_N_={HEAD_SIZE}"])
+    if distributed and torch.distributed.get_rank() == 0:
+        torch.distributed.barrier()
+    return wkv5_cuda
+
+@torch.jit.script
+def wkv5_decay(w):
+    # ew = -exp(w) and eew = exp(ew) in fp32, scripted so the fuser emits both from one kernel
+    ew = -torch.exp(w.float())
+    return ew, torch.exp(ew)
     
 class WKV_5(torch.autograd.Function):
     @staticmethod
-    def forward(ctx, B, T, C, H, r, k, v, w, u):
+    def forward(ctx, B, T, C, H, r, k, v, w, u, ew, eew):
+        # w is only an input for its gradient, the kernels use ew = -exp(w) and eew = exp(ew)
         with torch.no_grad():
             assert r.dtype == torch.bfloat16
             assert k.dtype == torch.bfloat16
@@ -59,11 +77,11 @@ class WKV_5(torch.autograd.Function):
             assert v.is_contiguous()
             assert w.is_contiguous()
             assert u.is_contiguous()
-            ew = (-torch.exp(w.float())).contiguous()
-            eew = (torch.exp(ew)).contiguous()
-            ctx.save_for_backward(r, k, v, eew, ew, u)
+            assert ew.is_contiguous()
+            assert eew.is_contiguous()
+            ctx.save_for_backward(r, k, v, ew, u) # eew = exp(ew) is recomputed in backward
             y = torch.empty((B, T, C), device=r.device, dtype=torch.bfloat16, memory_format=torch.contiguous_format) # .uniform_(-1, 1)
-            wkv5_cuda.forward(B, T, C, H, r, k, v, eew, u, y)
+            get_wkv5_cuda().forward(B, T, C, H, r, k, v, eew, u, y)
             return y
 
     @staticmethod
@@ -75,19 +93,30 @@ class WKV_5(torch.autograd.Function):
             C = ctx.C
             H = ctx.H
             assert gy.is_contiguous()
-            r, k, v, eew, ew, u = ctx.saved_tensors
+            r, k, v, ew, u = ctx.saved_tensors
+            eew = torch.exp(ew)
             gr = torch.empty((B, T, C), device=gy.device, requires_grad=False, dtype=torch.bfloat16, memory_format=torch.contiguous_format) # .uniform_(-1, 1)
             gk = torch.empty((B, T, C), device=gy.device, requires_grad=False, dtype=torch.bfloat16, memory_format=torch.contiguous_format) # .uniform_(-1, 1)
             gv = torch.empty((B, T, C), device=gy.device, requires_grad=False, dtype=torch.bfloat16, memory_format=torch.contiguous_format) # .uniform_(-1, 1)
-            gw = torch.empty((B, C), device=gy.device, requires_grad=False, dtype=torch.bfloat16, memory_format=torch.contiguous_format) # .uniform_(-1, 1)
-            gu = torch.empty((B, C), device=gy.device, requires_grad=False, dtype=torch.bfloat16, memory_format=torch.contiguous_format) # .uniform_(-1, 1)
-            wkv5_cuda.backward(B, T, C, H, r, k, v, eew, ew, u, gy, gr, gk, gv, gw, gu)
-            gw = torch.sum(gw, 0).view(H, C//H)
-            gu = torch.sum(gu, 0).view(H, C//H)
-            return (None, None, None, None, gr, gk, gv, gw, gu)
-
-def RUN_CUDA_RWKV5(B, T, C, H, r, k, v, w, u):
-    return WKV_5.apply(B, T, C, H, r, k, v, w, u)
+            # gw and gu are summed over the batch inside the kernel, in fp32
+            gw = torch.zeros((C,), device=gy.device, requires_grad=False, dtype=torch.float32)
+            gu = torch.zeros((C,), device=gy.device, requires_grad=False, dtype=torch.float32)
+            get_wkv5_cuda().backward(B, T, C, H, r, k, v, eew, ew, u, gy, gr, gk, gv, gw, gu)
+            gw = gw.view(H, C//H).to(torch.bfloat16)
+            gu = gu.view(H, C//H).to(torch.bfloat16)
+            return (None, None, None, None, gr, gk, gv, gw, gu, None, None)
+
+def RUN_CUDA_RWKV5(B, T, C, H, r, k, v, w, u, ew, eew):
+    return WKV_5.apply(B, T, C, H, r, k, v, w, u, ew, eew)
+
+# order of the fused projections in RWKV_TimeMix_RWKV5.kvrg / time_mix_kvrg
+KVRG_NAMES = ("key", "value", "receptance", "gate")
+
+def time_shift_mix(x, mix):
+    # x * mix + time_shift(x) * (1 - mix) for every stacked mix at once: the shifted copy is
+    # [B, T, C] and shared by all mixes, a single lerp kernel then writes the [N, B, T, C] output
+    xx = F.pad(x, (0, 0, 1, -1))
+    return torch.lerp(xx, x, mix.to(x.dtype))
 
 ########################################################################################################
 
@@ -106,53 +135,54 @@ class RWKV_TimeMix_RWKV5(MyModule):
         with torch.no_grad():
             ratio_0_to_1 = layer_id / (args.n_layer - 1)  # 0 to 1
             ratio_1_to_almost0 = 1.0 - (layer_id / args.n_layer)  # 1 to ~0
-            ddd = torch.ones(1, 1, args.n_embd)
-            for i in range(args.n_embd):
-                ddd[0, 0, i] = i / args.n_embd
+            ddd = (torch.arange(args.n_embd) / args.n_embd).view(1, 1, args.n_embd)
 
-            # fancy time_mix
-            self.time_mix_k = nn.Parameter(torch.pow(ddd, ratio_1_to_almost0))
-            self.time_mix_v = nn.Parameter(torch.pow(ddd, ratio_1_to_almost0) + 0.3 * ratio_0_to_1)
-            self.time_mix_r = nn.Parameter(torch.pow(ddd, 0.5 * ratio_1_to_almost0))
-            self.time_mix_g = nn.Parameter(torch.pow(ddd, 0.5 * ratio_1_to_almost0))
+            # fancy time_mix, stacked as [k, v, r, g] -> (4, 1, 1, n_embd)
+            time_mix_k = torch.pow(ddd, ratio_1_to_almost0)
+            time_mix_v = torch.pow(ddd, ratio_1_to_almost0) + 0.3 * ratio_0_to_1
+            time_mix_r = torch.pow(ddd, 0.5 * ratio_1_to_almost0)
+            time_mix_g = torch.pow(ddd, 0.5 * ratio_1_to_almost0)
+            self.time_mix_kvrg = nn.Parameter(torch.stack([time_mix_k, time_mix_v, time_mix_r, time_mix_g]))
 
             # fancy time_decay
-            decay_speed = torch.ones(args.dim_att)
-            for n in range(args.dim_att):
-                decay_speed[n] = -6 + 5 * (n / (args.dim_att - 1)) ** (0.7 + 1.3 * ratio_0_to_1)
+            n = torch.arange(args.dim_att)
+            decay_speed = -6 + 5 * (n / (args.dim_att - 1)) ** (0.7 + 1.3 * ratio_0_to_1)
             self.time_decay = nn.Parameter(decay_speed.reshape(self.n_head, self.head_size))
             # print(layer_id, self.time_decay.flatten()[:3].cpu().numpy(), '...', self.time_decay.flatten()[-3:].cpu().numpy())
 
-            tmp = torch.zeros(args.dim_att)
-            for n in range(args.dim_att):
-                zigzag = ((n + 1) % 3 - 1) * 0.1
-                tmp[n] = ratio_0_to_1 * (1 - (n / (args.dim_att - 1))) + zigzag
+            zigzag = ((n + 1) % 3 - 1) * 0.1
+            tmp = ratio_0_to_1 * (1 - (n / (args.dim_att - 1))) + zigzag
 
             self.time_faaaa = nn.Parameter(tmp.reshape(self.n_head, self.head_size))
 
-        self.time_shift = nn.ZeroPad2d((0, 0, 1, -1))
-        self.receptance = nn.Linear(args.n_embd, args.dim_att, bias=False)
-        self.key = nn.Linear(args.n_embd, args.dim_att, bias=False)
+        # key, value, receptance and gate weights concatenated along the output dim
+        self.kvrg = nn.Linear(args.n_embd, 4 * args.dim_att, bias=False)
 
-        self.value = nn.Linear(args.n_embd, args.dim_att, bias=False)
         self.output = nn.Linear(args.dim_att, args.n_embd, bias=False)
-        self.gate = nn.Linear(args.n_embd, args.dim_att, bias=False)
-        self.ln_x = nn.GroupNorm(self.n_head, args.dim_att)
+        # GroupNorm(x / head_size_divisor, eps) == GroupNorm(x, eps * head_size_divisor**2)
+        self.ln_x = nn.GroupNorm(self.n_head, args.dim_att, eps=(1e-5)*(args.head_size_divisor**2))
+        self._decay_cache = None # (version of time_decay, ew, eew), only used when not training
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # fuse checkpoints that store key/value/receptance/gate separately (e.g. pretrained RWKV)
+        if prefix + "key.weight" in state_dict:
+            state_dict[prefix + "kvrg.weight"] = torch.cat(
+                [state_dict.pop(prefix + f"{name}.weight") for name in KVRG_NAMES])
+        if prefix + "time_mix_k" in state_dict:
+            state_dict[prefix + "time_mix_kvrg"] = torch.stack(
+                [state_dict.pop(prefix + f"time_mix_{name[0]}") for name in KVRG_NAMES])
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     @MyFunction
     def jit_func(self, x):
         B, T, C = x.size()
 
-        xx = self.time_shift(x) # Mix x with the previous timestep to produce xk, xv, xr
-        xk = x * self.time_mix_k + xx * (1 - self.time_mix_k)
-        xv = x * self.time_mix_v + xx * (1 - self.time_mix_v)
-        xr = x * self.time_mix_r + xx * (1 - self.time_mix_r)
-        xg = x * self.time_mix_g + xx * (1 - self.time_mix_g)
+        xkvrg = time_shift_mix(x, self.time_mix_kvrg) # Mix x with the previous timestep to produce xk, xv, xr, xg: [4, B, T, C]
 
-        r = self.receptance(xr)
-        k = self.key(xk)
-        v = self.value(xv)
-        g = F.silu(self.gate(xg))
+        # one batched GEMM instead of four Linear calls
+        kvrg = torch.bmm(xkvrg.view(4, B * T, C), self.kvrg.weight.view(4, -1, C).transpose(1, 2))
+        k, v, r, g = kvrg.view(4, B, T, -1).unbind(0)
+        g = F.silu(g)
 
         return r, k, v, g
 
@@ -161,20 +191,63 @@ class RWKV_TimeMix_RWKV5(MyModule):
         B, T, C = x.size()
         x = x.view(B * T, C)
         
-        x = self.ln_x(x / self.head_size_divisor).view(B, T, C)
+        x = self.ln_x(x).view(B, T, C)
         x = self.output(x * g)
         return x
 
+    def get_decay(self):
+        # ew = -exp(time_decay), eew = exp(ew) in fp32 for the kernel
+        # time_decay is fixed outside of training, so compute them once there
+        w = self.time_decay
+        version = (w.data_ptr(), w._version)
+        if not self.training and self._decay_cache is not None and self._decay_cache[0] == version:
+            return self._decay_cache[1], self._decay_cache[2]
+        with torch.no_grad():
+            ew, eew = wkv5_decay(w)
+        # optimizers under deepspeed update .data without bumping the version, so never cache while training
+        self._decay_cache = None if self.training else (version, ew, eew)
+        return ew, eew
+
     def forward(self, x):
         B, T, C = x.size()
         H = self.n_head
 
         r, k, v, g = self.jit_func(x)
 
-        x = RUN_CUDA_RWKV5(B, T, C, H, r, k, v, w=self.time_decay, u=self.time_faaaa)
+        ew, eew = self.get_decay()
+        x = RUN_CUDA_RWKV5(B, T, C, H, r, k, v, w=self.time_decay, u=self.time_faaaa, ew=ew, eew=eew)
 
         return self.jit_func_2(x, g)
 
+    def forward_with_state(self, x, x_prev, wkv_state):
+        # x: [B, T, C] following the tokens already in the state
+        # x_prev: [B, C] input of the previous token, wkv_state: [B, H, N, N] in fp32
+        B, T, C = x.size()
+        H, N = self.n_head, self.head_size
+
+        xx = torch.cat((x_prev.unsqueeze(1), x[:, :-1, :]), dim=1) # the first token mixes with x_prev
+        xkvrg = torch.lerp(xx, x, self.time_mix_kvrg.to(x.dtype))
+        kvrg = torch.bmm(xkvrg.view(4, B * T, C), self.kvrg.weight.view(4, -1, C).transpose(1, 2))
+        k, v, r, g = kvrg.view(4, B, T, -1).unbind(0)
+        g = F.silu(g)
+
+        ew, eew = self.get_decay()
+        if T > 1: # prompt, the cuda kernel starts from an empty state
+            y = RUN_CUDA_RWKV5(B, T, C, H, r, k, v, w=self.time_decay, u=self.time_faaaa, ew=ew, eew=eew)
+            y = y.float().view(B, T, H, N)
+        r, k, v = r.float().view(B, T, H, N), k.float().view(B, T, H, N), v.float().view(B, T, H, N)
+        if T == 1: # one token: y_i = sum_j r_j * u_j * k_j * v_i
+            y = (r * self.time_faaaa.float() * k).sum(dim=-1, keepdim=True) * v
+        # add what the tokens read from wkv_state, which decays by w = exp(-exp(time_decay)) per token
+        w = eew.view(H, N).unsqueeze(-1) ** torch.arange(T + 1, device=x.device) # [H, N, T + 1]: w^0 .. w^T
+        w = w.permute(2, 0, 1) # [T + 1, H, N]
+        y = y + torch.einsum('bthj,bhji->bthi', r * w[:T], wkv_state)
+        # the state after the last token
+        wkv_state = torch.einsum('bthj,bthi->bhji', k * w[:T].flip(0), v) + w[T].unsqueeze(-1) * wkv_state
+
+        x_prev = x[:, -1, :].clone()
+        return self.jit_func_2(y.view(B, T, C).to(x.dtype), g), x_prev, wkv_state
+
 ########################################################################################################
 
 class RWKV_ChannelMix(MyModule):
@@ -182,30 +255,43 @@ class RWKV_ChannelMix(MyModule):
         super().__init__()
         self.args = args
         self.layer_id = layer_id
-        self.time_shift = nn.ZeroPad2d((0, 0, 1, -1))
 
         with torch.no_grad():  # fancy init of time_mix
             ratio_1_to_almost0 = 1.0 - (layer_id / args.n_layer)  # 1 to ~0
-            ddd = torch.ones(1, 1, args.n_embd)
-            for i in range(args.n_embd):
-                ddd[0, 0, i] = i / args.n_embd
-            self.time_mix_k = nn.Parameter(torch.pow(ddd, ratio_1_to_almost0))
-            self.time_mix_r = nn.Parameter(torch.pow(ddd, ratio_1_to_almost0))
+            ddd = (torch.arange(args.n_embd) / args.n_embd).view(1, 1, args.n_embd)
+            # stacked as [k, r] -> (2, 1, 1, n_embd)
+            time_mix_k = torch.pow(ddd, ratio_1_to_almost0)
+            time_mix_r = torch.pow(ddd, ratio_1_to_almost0)
+            self.time_mix_kr = nn.Parameter(torch.stack([time_mix_k, time_mix_r]))
         
         self.key = nn.Linear(args.n_embd, args.dim_ffn, bias=False)
         self.receptance = nn.Linear(args.n_embd, args.n_embd, bias=False)
         self.value = nn.Linear(args.dim_ffn, args.n_embd, bias=False)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # stack checkpoints that store time_mix_k/time_mix_r separately (e.g. pretrained RWKV)
+        if prefix + "time_mix_k" in state_dict:
+            state_dict[prefix + "time_mix_kr"] = torch.stack(
+                [state_dict.pop(prefix + "time_mix_k"), state_dict.pop(prefix + "time_mix_r")])
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     @MyFunction
     def forward(self, x):
-        xx = self.time_shift(x)
-        xk = x * self.time_mix_k + xx * (1 - self.time_mix_k)
-        xr = x * self.time_mix_r + xx * (1 - self.time_mix_r)
+        xk, xr = time_shift_mix(x, self.time_mix_kr).unbind(0)
         k = self.key(xk)
-        k = torch.relu(k) ** 2
+        k = torch.square(torch.relu_(k)) # relu in place on the fresh projection, no extra [B, T, dim_ffn] buffer
         kv = self.value(k)
         return torch.sigmoid(self.receptance(xr)) * kv
 
+    def forward_with_state(self, x, x_prev):
+        # x: [B, T, C] following the tokens already in the state, x_prev: [B, C] input of the previous token
+        xx = torch.cat((x_prev.unsqueeze(1), x[:, :-1, :]), dim=1) # the first token mixes with x_prev
+        xk, xr = torch.lerp(xx, x, self.time_mix_kr.to(x.dtype)).unbind(0)
+        k = self.key(xk)
+        k = torch.square(torch.relu_(k))
+        kv = self.value(k)
+        return torch.sigmoid(self.receptance(xr)) * kv, x[:, -1, :].clone()
+
 ########################################################################################################
 # The RWKV Model with our blocks
 ########################################################################################################
@@ -234,27 +320,47 @@ class Block(nn.Module):
             self.drop0 = nn.Dropout(p = args.dropout)
             self.drop1 = nn.Dropout(p = args.dropout)
         
+    def _att_half(self, x):
+        if self.layer_id == 0 and self.args.pre_ffn > 0:
+            x = x + self.ffnPre(self.ln1(x))
+        else:
+            x = x + self.att(self.ln1(x))
+        if self.args.dropout > 0:
+            x = self.drop0(x)
+        return x
+
+    def _ffn_half(self, x):
+        x = x + self.ffn(self.ln2(x))
+        if self.args.dropout > 0:
+            x = self.drop1(x)
+        return x
+
     def forward(self, x):
-        args = self.args
-        B, T, C = x.size()
         if self.layer_id == 0:
             x = self.ln0(x)
 
-        if self.args.dropout == 0:
-            if self.layer_id == 0 and args.pre_ffn > 0:
-                x = x + self.ffnPre(self.ln1(x))
-            else:
-                x = x + self.att(self.ln1(x))
-            x = x + self.ffn(self.ln2(x))
+        x = self._att_half(x)
+        # grad_cp 2: only recompute the ffn half, the wkv activations are kept so the kernel runs once
+        if self.args.grad_cp == 2:
+            x = checkpoint(self._ffn_half, x, use_reentrant=False)
         else:
-            if self.layer_id == 0 and args.pre_ffn > 0:
-                x = self.drop0(x + self.ffnPre(self.ln1(x)))
-            else:
-                x = self.drop0(x + self.att(self.ln1(x)))
-            x = self.drop1(x + self.ffn(self.ln2(x)))
+            x = self._ffn_half(x)
 
         return x
 
+    def forward_with_state(self, x, state):
+        # for generation, state of this layer: [att x_prev, att wkv state, ffn x_prev], replaced in place
+        if self.layer_id == 0:
+            x = self.ln0(x)
+
+        if self.layer_id == 0 and self.args.pre_ffn > 0:
+            dx, state[0] = self.ffnPre.forward_with_state(self.ln1(x), state[0])
+        else:
+            dx, state[0], state[1] = self.att.forward_with_state(self.ln1(x), state[0], state[1])
+        x = x + dx
+        dx, state[2] = self.ffn.forward_with_state(self.ln2(x), state[2])
+        return x + dx
+
 
 class L2Wrap(torch.autograd.Function):
     @staticmethod
@@ -309,7 +415,7 @@ class RWKV(pl.LightningModule):
             x = self.drop0(x)
 
         for block in self.blocks:
-            if args.grad_cp == 1:
+            if args.grad_cp == 1: # recompute the whole block, grad_cp 2 is done inside the block
                 x = deepspeed.checkpointing.checkpoint(block, x)
             else:
                 x = block(x)
@@ -320,6 +426,24 @@ class RWKV(pl.LightningModule):
 
         return x
 
+    def empty_state(self, B, device, dtype):
+        args = self.args
+        H, N = args.dim_att // args.head_size_a, args.head_size_a
+        return [[torch.zeros((B, args.n_embd), device=device, dtype=dtype),
+                 torch.zeros((B, H, N, N), device=device, dtype=torch.float32),
+                 torch.zeros((B, args.n_embd), device=device, dtype=dtype)] for _ in range(args.n_layer)]
+
+    def forward_with_state(self, x, state):
+        # x: [B, T, n_embd] embeddings of the tokens after the ones in state, state is updated in place
+        for block, block_state in zip(self.blocks, state):
+            x = block.forward_with_state(x, block_state)
+
+        x = self.ln_out(x)
+
+        x = self.head(x)
+
+        return x
+
     def training_step(self, batch, batch_idx):
         idx, targets = batch
         logits = self(idx)
@@ -342,6 +466,9 @@ class VisualRWKV(pl.LightningModule):
             self.load_rwkv_from_pretrained(args.load_model)
         self.vit = CLIPVisionModel.from_pretrained(args.vision_tower_name)
         self.vit.requires_grad_(False)
+        if getattr(args, "compile_vit", 0):
+            # compile the forward only, so the state dict keys of the vit stay the same
+            self.vit.forward = torch.compile(self.vit.forward)
         self.proj = nn.Linear(self.vit.config.hidden_size, args.n_embd, bias=False)
         self.align = ContrastiveAlignment(self.proj, args.queue_size, 
                                           args.ctx_len, args.vision_ctx_len, 
@@ -392,27 +519,39 @@ class VisualRWKV(pl.LightningModule):
         return FusedAdam(optim_groups, lr=self.args.lr_init, betas=self.args.betas, eps=self.args.adam_eps, bias_correction=True, adam_w_mode=True, amsgrad=False)
 
     def forward(self, samples):
+        is_image_token = (samples["input_ids"] == IMAGE_TOKEN_INDEX)
+        # replace IMAGE_TOKEN_INDEX with PAD_TOKEN_INDEX, the text embeddings are shared
+        # by the input of rwkv and the constraive loss
+        input_ids = samples["input_ids"].masked_fill(is_image_token, PAD_TOKEN_INDEX)
+        text_embeds = self.rwkv.emb(input_ids)
+        # pure text batch on every rank, skip the vit and the constraive loss. a single
+        # rank must not skip alone, proj and align would miss their gradients there
+        has_image = is_image_token.any().int()
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            torch.distributed.all_reduce(has_image, op=torch.distributed.ReduceOp.MAX)
+        if not has_image:
+            no_image_features = text_embeds.new_zeros(text_embeds.shape[0], 0, text_embeds.shape[-1])
+            x, targets = self.preparing_embedding(samples, no_image_features, text_embeds=text_embeds)
+            logits = self.rwkv(x)
+            return logits, targets, torch.tensor(0.0, device=logits.device, requires_grad=True)
         # encode images
         image_features  = self.encode_images(samples["images"], do_proj=False)
         image_features_projected = self.proj(image_features)
         # prepare embedding
-        x, targets = self.preparing_embedding(samples, image_features_projected)
+        x, targets = self.preparing_embedding(samples, image_features_projected, text_embeds=text_embeds)
         logits = self.rwkv(x)
         # compute constraive loss
-        # replace IMAGE_TOKEN_INDEX with PAD_TOKEN_INDEX
-        input_ids = samples["input_ids"].clone()
-        input_ids[input_ids == IMAGE_TOKEN_INDEX] = PAD_TOKEN_INDEX
         text_masks = (input_ids != PAD_TOKEN_INDEX)
-        text_embeds = self.rwkv.emb(input_ids)
         constraive_loss = self.align(text_embeds=text_embeds, vision_embeds=image_features, text_masks=text_masks)
         return logits, targets, constraive_loss
     
     def training_step(self, batch, batch_idx):
         logits, targets, constraive_loss = self(batch)
-        shift_logits = logits[..., :-1, :].contiguous()
-        shift_labels = targets[..., 1:].contiguous()
-        loss = F.cross_entropy(shift_logits.view(-1, shift_logits.size(-1)),
-                               shift_labels.view(-1))
+        # shift the labels instead of the logits, the last position has no target
+        # and is ignored, so the [B, T, V] logits are never copied
+        shift_labels = F.pad(targets[:, 1:], (0, 1), value=IGNORE_INDEX)
+        loss = F.cross_entropy(logits.view(-1, logits.size(-1)),
+                               shift_labels.view(-1), ignore_index=IGNORE_INDEX)
         constraive_loss = constraive_loss * self.args.constraive_loss_weight
         # record loss
         if not hasattr(self.trainer, "lm_loss_all"):
@@ -434,12 +573,10 @@ class VisualRWKV(pl.LightningModule):
                 self.trainer.my_loss_all = all
     
     def encode_images(self, images, do_proj=True):
-        B, N, C, H, W = images.shape
-        images = images.view(B*N, C, H, W)
-        image_features = self.vit(images).last_hidden_state
-        L, D = image_features.shape[1], image_features.shape[2]
-        # rerange [B*N, L, D] -> [B, N, L, D]
-        image_features = image_features.view(B, N, L, D)[:, 0, :, :]
+        # only the first image of each sample is used, skip the vit for the others
+        images = images[:, 0, :, :, :]
+        with torch.no_grad(): # the vit is frozen
+            image_features = self.vit(images).last_hidden_state
         image_features = self.grid_pooling(image_features)
         if do_proj:
             return self.proj(image_features)
@@ -466,52 +603,42 @@ class VisualRWKV(pl.LightningModule):
         image_features = image_features.permute(0, 2, 3, 1).view(B, -1, D)
         return torch.cat((cls_features, image_features), dim=1)
    
-    def preparing_embedding(self, samples, image_features, truncate=True):
-        device, label_dtype = samples["labels"].device, samples["labels"].dtype
-        emb_dtype = samples["images"].dtype
+    def preparing_embedding(self, samples, image_features, truncate=True, text_embeds=None):
+        input_ids, labels = samples["input_ids"], samples["labels"]
+        device, emb_dtype = input_ids.device, samples["images"].dtype
+        B, S = input_ids.shape
+        L = image_features.shape[1]
+        is_image_token = (input_ids == IMAGE_TOKEN_INDEX)
+        num_images = is_image_token.sum(dim=1)
+        if (num_images > 1).any():
+            raise ValueError(f"Too many images in one sample: {num_images.max().item()}, should be 0 or 1.")
+        has_image = (num_images == 1).unsqueeze(1) # [B, 1]
         ### prepare input token
-        new_input_embeds = []
-        new_labels = []
-        for idx, cur_input_ids in enumerate(samples["input_ids"]):
-            num_images = (cur_input_ids == IMAGE_TOKEN_INDEX).sum()
-            if num_images == 0: # no image in this sample
-                new_input_embeds.append(self.rwkv.emb(cur_input_ids))
-                new_labels.append(samples["labels"][idx])
-            elif num_images == 1: # only one image in this sample
-                image_token_indice = torch.where(cur_input_ids == IMAGE_TOKEN_INDEX)[0][0]
-                cur_labels = samples["labels"][idx]
-                # first text part
-                cur_new_input_embeds = [self.rwkv.emb(cur_input_ids[:image_token_indice])]
-                cur_new_labels = [cur_labels[:image_token_indice]]
-                # image part
-                cur_image_features = image_features[idx]
-                cur_new_input_embeds.append(cur_image_features)
-                cur_new_labels.append(torch.full((cur_image_features.shape[0],), IGNORE_INDEX, device=device, dtype=label_dtype))
-                # last text part
-                cur_new_input_embeds.append(self.rwkv.emb(cur_input_ids[image_token_indice+1:]))
-                cur_new_labels.append(cur_labels[image_token_indice+1:])
-                # concat them
-                cur_new_input_embeds = torch.cat(cur_new_input_embeds)
-                cur_new_labels = torch.cat(cur_new_labels)
-
-                new_input_embeds.append(cur_new_input_embeds)
-                new_labels.append(cur_new_labels)
-            else:
-                raise ValueError(f"Too many images in one sample: {num_images}, should be 0 or 1.")
+        # one emb call for the whole batch, the image token itself is replaced by the image features below
+        if text_embeds is None:
+            text_embeds = self.rwkv.emb(input_ids.masked_fill(is_image_token, PAD_TOKEN_INDEX))
+        # a sample with image becomes [text before the image, image features, text after the image]
+        new_len = S + has_image.squeeze(1) * (L - 1)
+        max_len = new_len.max().item()
         # Truncate sequences to max length as image embeddings can make the sequence longer
         if truncate:
-            new_input_embeds = [x[:self.args.ctx_len] for x in new_input_embeds]
-            new_labels = [x[:self.args.ctx_len] for x in new_labels]
-        # Combine them
-        max_len = max(x.shape[0] for x in new_input_embeds)
-        batch_size = len(new_input_embeds)
-        new_input_embeds_padded = torch.zeros((batch_size, max_len, self.args.n_embd), dtype=emb_dtype, device=device)
-        new_labels_padded = torch.full((batch_size, max_len), IGNORE_INDEX, dtype=label_dtype, device=device)
-        for i, (cur_new_embed, cur_new_labels) in enumerate(zip(new_input_embeds, new_labels)):
-            cur_len = cur_new_embed.shape[0]
-            new_input_embeds_padded[i, :cur_len] = cur_new_embed
-            new_labels_padded[i, :cur_len] = cur_new_labels
-        return new_input_embeds_padded, new_labels_padded
+            max_len = min(max_len, self.args.ctx_len)
+        # position p of a new sequence is read from index[:, p] of [text, image features]
+        position = torch.arange(max_len, device=device).unsqueeze(0)
+        image_token_indice = is_image_token.int().argmax(dim=1, keepdim=True) # 0 if no image
+        index = torch.where(has_image & (position >= image_token_indice),
+                            torch.where(position < image_token_indice + L, S + position - image_token_indice, position - L + 1),
+                            position)
+        is_pad = (position >= new_len.unsqueeze(1))
+        is_image = has_image & (position >= image_token_indice) & (position < image_token_indice + L)
+        index = index.masked_fill(is_pad, 0)
+        # Combine them, padding is a zero embedding with IGNORE_INDEX label
+        new_input_embeds = torch.cat([text_embeds, image_features], dim=1)
+        new_input_embeds = new_input_embeds.gather(1, index.unsqueeze(-1).expand(-1, -1, new_input_embeds.shape[-1]))
+        new_input_embeds = new_input_embeds.masked_fill(is_pad.unsqueeze(-1), 0)
+        # image positions point past the text, they are clamped and their labels masked like the padding
+        new_labels = labels.gather(1, index.clamp(max=S - 1)).masked_fill(is_pad | is_image, IGNORE_INDEX)
+        return new_input_embeds.to(emb_dtype), new_labels
     
     def generate(self, input_ids, images, do_sample, temperature, top_p, max_new_tokens, stop_token_idx) -> list[int]:
         ''' one mode to generate, only generate one sample at a time
@@ -528,10 +655,13 @@ class VisualRWKV(pl.LightningModule):
         image_features  = self.encode_images(samples["images"], do_proj=True)
         # prepare embedding
         x, _ = self.preparing_embedding(samples, image_features, truncate=False)
+        # the prompt runs once and leaves the rwkv state of every layer,
+        # each new token then only updates the state, so there is no need to truncate to ctx_len
+        state = self.rwkv.empty_state(x.shape[0], x.device, x.dtype)
+        logits = self.rwkv.forward_with_state(x, state)[:, -1, :]
         # generate
         generated = []
         for i in range(max_new_tokens):
-            logits = self.rwkv(x)[:, -1, :]
             if do_sample:
                 raise NotImplementedError
             else: # greedy
@@ -540,8 +670,7 @@ class VisualRWKV(pl.LightningModule):
             generated.append(next_token.item())
             if generated[-1] == stop_token_idx:
                 break
-            x = torch.cat((x, self.rwkv.emb(next_token)), dim=-2)
-            x = x[:, -self.args.ctx_len:, :] # truncate
+            logits = self.rwkv.forward_with_state(self.rwkv.emb(next_token), state)[:, -1, :]
         return generated
     
 
@@ -558,8 +687,10 @@ class ContrastiveAlignment(nn.Module):
         self.text_embed_dim = text_embed_dim
         self.vision_embed_dim = vision_embed_dim
         self.reduction = reduction
-        self.register_buffer("text_queue", torch.zeros(queue_size, text_max_len, text_embed_dim))
-        self.register_buffer("vision_queue", torch.zeros(queue_size, vision_max_len, vision_embed_dim))
+        # the queues only hold detached negatives, keep them in bf16 to halve their memory and reads
+        self.register_buffer("text_queue", torch.zeros(queue_size, text_max_len, text_embed_dim, dtype=torch.bfloat16))
+        # vision features are queued after proj, so the negatives are projected once when enqueued
+        self.register_buffer("vision_queue_projected", torch.zeros(queue_size, vision_max_len, text_embed_dim, dtype=torch.bfloat16))
         self.register_buffer("queue_ptr", torch.zeros(1, dtype=torch.long))
 
     def pool_features(self, text_embeds, vision_features, text_masks=None):
@@ -569,12 +700,14 @@ class ContrastiveAlignment(nn.Module):
             vision_pooled_features = vision_features.mean(dim=1)
             text_pooled_embeds = text_embeds.sum(dim=1) / text_masks.sum(dim=-1, keepdim=True)
         elif self.reduction == 'weighted':
-            text2vision_similarities = torch.einsum('ntd,nvd->ntv', text_embeds, vision_features)
+            # the text to vision similarities [N, T, V] are only used through their means,
+            # which are the similarities to the mean of the other side, so never build them
+            text2vision_similarities = torch.einsum('ntd,nd->nt', text_embeds, vision_features.mean(dim=1)) # [N, T]
+            vision2text_similarities = torch.einsum('nvd,nd->nv', vision_features, text_embeds.mean(dim=1)) # [N, V]
             # mask out padding tokens
-            text_embeds_weights = text2vision_similarities.mean(dim=-1) + (~text_masks) * (-1e9)
-            text_embeds_weights = torch.softmax(text2vision_similarities.mean(dim=-1), dim=-1) # [N, T]
+            text_embeds_weights = torch.softmax(text2vision_similarities.masked_fill(~text_masks, -1e9), dim=-1) # [N, T]
             text_pooled_embeds = torch.einsum('ntd,nt->nd', text_embeds, text_embeds_weights)
-            vision_features_weights = torch.softmax(text2vision_similarities.mean(dim=-2), dim=-1) # [N, V]
+            vision_features_weights = torch.softmax(vision2text_similarities, dim=-1) # [N, V]
             vision_pooled_features = torch.einsum('nvd,nv->nd', vision_features, vision_features_weights)
         else:
             raise ValueError(f"Unknown reduction: {self.reduction}")
@@ -583,14 +716,12 @@ class ContrastiveAlignment(nn.Module):
     def compute_in_batch_constraive_loss(self, text_embeds, vision_features, text_masks):
         # first pool the vision features and text embeds
         text_pooled_embeds, vision_pooled_features = self.pool_features(text_embeds, vision_features, text_masks)
-        # Calculate pairwise similarity
+        # Calculate pairwise similarity, v2t is the transpose of t2v
         t2v_matrix = text_pooled_embeds @ vision_pooled_features.T # [N, N]
-        v2t_matrix = vision_pooled_features @ text_pooled_embeds.T # [N, N]
-        # Calculate the loss
-        labels = torch.arange(text_embeds.shape[0], device=text_embeds.device)
-        t2v_loss = F.cross_entropy(t2v_matrix, labels, label_smoothing=0.1)
-        v2t_loss = F.cross_entropy(v2t_matrix, labels, label_smoothing=0.1)
-        return (t2v_loss + v2t_loss) / 2
+        logits = torch.cat((t2v_matrix, t2v_matrix.T), dim=0) # [2N, N]
+        # Calculate the loss, the mean over 2N rows is the average of the t2v and v2t losses
+        labels = torch.arange(text_embeds.shape[0], device=text_embeds.device).repeat(2)
+        return F.cross_entropy(logits, labels, label_smoothing=0.1)
     
     def compute_in_queue_constraive_loss(self, text_embeds, vision_features, text_masks, text_neg_embeds, vision_neg_features):
         # first pool the vision features and text embeds
@@ -616,11 +747,11 @@ class ContrastiveAlignment(nn.Module):
         batch_size = text_embeds.shape[0]
         # project to the same space
         vision_features = self.proj(vision_embeds)
-        vision_neg_embeds = self.vision_queue.clone().detach()
-        vision_neg_features = self.proj(vision_neg_embeds)
+        # the queues are buffers without grad, they are only written after the loss is computed
+        vision_neg_features = self.vision_queue_projected.to(vision_features.dtype)
         # apply mask, make padding tokens zero
         text_embeds = text_embeds * text_masks.unsqueeze(-1)
-        text_neg_embeds = self.text_queue.clone().detach()
+        text_neg_embeds = self.text_queue.to(text_embeds.dtype)
         # compute loss, when batch_size == 1, only compute in_queue loss
         if batch_size != 1:
             in_batch_loss = self.compute_in_batch_constraive_loss(text_embeds, vision_features, text_masks)
@@ -629,7 +760,13 @@ class ContrastiveAlignment(nn.Module):
         else:
             loss = self.compute_in_queue_constraive_loss(text_embeds, vision_features, text_masks, text_neg_embeds, vision_neg_features)
         # update queue
-        self.text_queue[self.queue_ptr:self.queue_ptr+batch_size, :] = text_embeds
-        self.vision_queue[self.queue_ptr:self.queue_ptr+batch_size, :] = vision_embeds
-        self.queue_ptr = (self.queue_ptr + batch_size) % self.queue_size
-        return loss
\ No newline at end of file
+        self._dequeue_and_enqueue(text_embeds, vision_features)
+        return loss
+
+    @torch.no_grad()
+    def _dequeue_and_enqueue(self, text_embeds, vision_features):
+        batch_size = text_embeds.shape[0]
+        ptr = int(self.queue_ptr)
+        self.text_queue[ptr:ptr+batch_size, :] = text_embeds
+        self.vision_queue_projected[ptr:ptr+batch_size, :] = vision_features
+        self.queue_ptr[0] = (ptr + batch_size) % self.queue_size
\ No newline at end of file